@@ -0,0 +1,68 @@
+import json
+import os
+import pathlib
+import re
+import shutil
+import sqlite3
+import tempfile
+import zipfile
+
+def strip_markup(field):
+    # Sentence cards wrap starred words in a span, and Anki may have added other html or entities while editing
+    text = re.sub(r'<[^>]*>', '', field)
+    return text.replace('&nbsp;', ' ').strip()
+
+def model_hanzi_fields(connection, model_names):
+    # Maps the id of each of our models to the position of its Hanzi field. Newer collections keep models in their own tables.
+    tables = set(name for (name,) in connection.execute("select name from sqlite_master where type = 'table'"))
+    fields = {}
+    if 'notetypes' in tables:
+        for model_id, name in connection.execute('select id, name from notetypes'):
+            if name in model_names:
+                positions = [position for (position,) in connection.execute("select ord from fields where ntid = ? and name = 'Hanzi'", (model_id,))]
+                fields[model_id] = positions[0] if positions else 1
+    else:
+        (models,) = connection.execute('select models from col').fetchone()
+        for model_id, model in json.loads(models).items():
+            if model['name'] in model_names:
+                positions = [field['ord'] for field in model['flds'] if field['name'] == 'Hanzi']
+                fields[int(model_id)] = positions[0] if positions else 1
+    return fields
+
+def read_collection_hanzi(path, model_names):
+    # as_uri escapes any # or ? in the path, which sqlite would otherwise read as the end of the file name
+    connection = sqlite3.connect(pathlib.Path(path).resolve().as_uri() + '?mode=ro', uri=True)
+    try:
+        fields = model_hanzi_fields(connection, model_names)
+        hanzi = set()
+        for model_id, flds in connection.execute('select mid, flds from notes'):
+            if model_id in fields:
+                values = flds.split('\x1f')
+                if fields[model_id] < len(values):
+                    hanzi.add(strip_markup(values[fields[model_id]]))
+        return hanzi
+    finally:
+        connection.close()
+
+def read_package_hanzi(path, model_names):
+    # An .apkg is a zip around a collection, which sqlite can only open once it's extracted
+    directory = tempfile.mkdtemp(prefix='gencards-apkg-')
+    try:
+        with zipfile.ZipFile(path) as package:
+            names = package.namelist()
+            if 'collection.anki21b' in names and 'collection.anki21' not in names:
+                raise ValueError('{0} was exported in the newer compressed format, export it again with "Support older Anki versions" ticked'.format(path))
+            collection_name = 'collection.anki21' if 'collection.anki21' in names else 'collection.anki2'
+            package.extract(collection_name, directory)
+        return read_collection_hanzi(os.path.join(directory, collection_name), model_names)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def read_existing_hanzi(paths, model_names):
+    hanzi = set()
+    for path in paths:
+        if path.endswith('.apkg') or path.endswith('.colpkg'):
+            hanzi |= read_package_hanzi(path, model_names)
+        else:
+            hanzi |= read_collection_hanzi(path, model_names)
+    return hanzi
@@ -0,0 +1,13 @@
+def make_batches(items, max_items, max_chars, size=len):
+    batch = []
+    batch_chars = 0
+    for item in items:
+        item_chars = size(item)
+        if batch and (len(batch) >= max_items or batch_chars + item_chars > max_chars):
+            yield batch
+            batch = []
+            batch_chars = 0
+        batch.append(item)
+        batch_chars += item_chars
+    if batch:
+        yield batch
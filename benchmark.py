@@ -0,0 +1,200 @@
+import argparse
+import csv
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from fakeservices import FakeServices
+from dictindex import load_index
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('gencards.benchmark')
+
+def sample_words(index, count, rng):
+    # Real dictionary words, so parsing and local readings do the same work they would on real input
+    words = []
+    while len(words) < count:
+        position = rng.randrange(index.count)
+        word = index.key(position).decode('utf-8')
+        if 1 <= len(word) <= 4 and all('一' <= character <= '鿿' for character in word):
+            words.append(word)
+    return words
+
+def generate_input(path, rows, sentence_ratio=0.5, definition_ratio=0.2, dictionary_path='dictionary', is_trad=False, seed=1):
+    rng = random.Random(seed)
+    index = load_index(dictionary_path, is_trad)
+    try:
+        vocabulary = sample_words(index, max(100, rows * 2), rng)
+    finally:
+        index.close()
+    with open(path, 'w', encoding='utf-8', newline='') as input_file:
+        writer = csv.writer(input_file)
+        for i in range(rows):
+            if rng.random() < sentence_ratio:
+                mandarin = ''.join(rng.choice(vocabulary) for _ in range(rng.randint(4, 8))) + '。'
+            else:
+                mandarin = vocabulary[i % len(vocabulary)] if i < len(vocabulary) else rng.choice(vocabulary)
+            if rng.random() < definition_ratio:
+                writer.writerow([mandarin, 'definition ' + str(i)])
+            else:
+                writer.writerow([mandarin])
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def benchmark_config(load_config, args, directory):
+    config = load_config(os.path.join(directory, 'config.ini'), interactive=False)
+    for section, option, value in [
+        ('azure', 'translator_api_key', 'fake'), ('azure', 'translator_api_endpoint', 'https://localhost'),
+        ('azure', 'speech_api_key', 'fake'), ('azure', 'speech_api_endpoint', 'https://localhost'),
+        ('azure', 'region', 'local'), ('azure', 'speech_audio_format', args.audio_format),
+        ('openai', 'is_chatgpt_enabled', 'true' if args.chatgpt else 'false'),
+        ('openai', 'api_key', 'fake'), ('openai', 'organisation', 'fake'),
+        ('openai', 'requests_per_minute', str(args.chat_rpm or 100000)),
+        ('openai', 'tokens_per_minute', str(args.chat_tpm)),
+        ('mandarin', 'is_trad', 'true' if args.trad else 'false'),
+        ('mandarin', 'dictionary_index_path', os.path.abspath(args.dictionary)),
+        ('cache', 'is_cache_enabled', 'true' if args.cache else 'false'),
+        ('cache', 'path', os.path.join(directory, 'cache.sqlite')),
+        ('cache', 'media_path', os.path.join(directory, 'media')),
+        ('incremental', 'manifest_path', os.path.join(directory, 'manifest.json')),
+        ('metrics', 'path', os.path.join(directory, 'metrics.json'))]:
+        if config.has_section(section):
+            config[section][option] = value
+    for option in args.set or []:
+        name, value = option.split('=', 1)
+        section, option = name.split('.', 1)
+        config[section][option] = value
+    return config
+
+def run_gencards(args, directory, input_path):
+    import gencards
+    generator = gencards.CardGenerator(benchmark_config(gencards.load_config, args, directory))
+    stages = generator.stages()
+    result = {}
+    try:
+        started = time.perf_counter()
+        output_package = generator.build_package(gencards.read_input_rows(input_path), stages)
+        result['build_seconds'] = time.perf_counter() - started
+        started = time.perf_counter()
+        generator.write_package(output_package, os.path.join(directory, 'output.apkg'))
+        result['write_seconds'] = time.perf_counter() - started
+    finally:
+        generator.close()
+    # Taken from the run metrics rather than the stages, so sharded runs include every process
+    counters = generator.metrics.summary()['counters']
+    result['stages'] = {stage.name: {'seconds': counters.get('stage.{0}.busy_seconds'.format(stage.name), 0),
+                                     'items': counters.get('stage.{0}.items'.format(stage.name), 0)} for stage in stages}
+    latency = generator.metrics.summary()['latency']
+    result['calls'] = {name: latency[name]['count'] for name in ('translator.translate', 'translator.transliterate', 'speech.synthesize', 'speech.synthesize_batch', 'chat.completion') if name in latency}
+    result['notes'] = len(output_package.decks[0].notes)
+    result['media_files'] = len(output_package.media_files)
+    result['apkg_bytes'] = os.path.getsize(os.path.join(directory, 'output.apkg'))
+    result['metrics'] = generator.metrics.summary()
+    return result
+
+def run_gensents(args, directory, input_path):
+    import gensents
+    generator = gensents.SentenceGenerator(benchmark_config(gensents.load_config, args, directory))
+    result = {}
+    started = time.perf_counter()
+    rows = list(gensents.read_input_rows(input_path))
+    words = generator.find_words(rows)
+    result['stages'] = {'find_words': {'seconds': time.perf_counter() - started, 'items': len(rows)}}
+    started = time.perf_counter()
+    sentences = sum(len(chunk_rows) for chunk_rows in generator.generate_sentences(words))
+    result['stages']['generate_sentences'] = {'seconds': time.perf_counter() - started, 'items': len(words)}
+    result['build_seconds'] = sum(stage['seconds'] for stage in result['stages'].values())
+    result['sentences'] = sentences
+    return result
+
+def format_report(report):
+    lines = ['{script}: {rows} rows in {total_seconds:.2f}s, {rows_per_second:.1f} rows/s'.format(**report)]
+    calls = report.get('calls', report['services']['calls'])
+    if calls:
+        lines.append('Calls per row: ' + ', '.join('{0} {1:.3f}'.format(name, count / report['rows']) for name, count in sorted(calls.items())))
+    for name in ('errors', 'throttled', 'slow'):
+        if report['services'][name]:
+            lines.append(name.capitalize() + ': ' + ', '.join('{0} {1}'.format(service, count) for service, count in sorted(report['services'][name].items())))
+    for name, stage in report['stages'].items():
+        lines.append('  {0:<20} {1:8.2f}s busy {2:8} items'.format(name, stage['seconds'], stage['items']))
+    if 'write_seconds' in report:
+        lines.append('Package write: {0:.2f}s, {1:.1f} KB'.format(report['write_seconds'], report['apkg_bytes'] / 1024))
+    if report['peak_memory_mb'] is not None:
+        lines.append('Peak memory: {0:.1f} MB'.format(report['peak_memory_mb']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure gencards or gensents against local fake services, without a network or credentials.')
+    parser.add_argument('--script', choices=['gencards', 'gensents'], default='gencards')
+    parser.add_argument('--rows', type=int, default=500, help='Rows of synthetic input to generate')
+    parser.add_argument('--input', help='Use this input.csv instead of generating one')
+    parser.add_argument('--sentence-ratio', type=float, default=0.5, help='Share of generated rows which are sentences')
+    parser.add_argument('--definition-ratio', type=float, default=0.2, help='Share of generated rows which come with a definition')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--translator-latency', type=float, default=0.1, help='Seconds per Translator request')
+    parser.add_argument('--speech-latency', type=float, default=0.3, help='Seconds per synthesis request')
+    parser.add_argument('--chat-latency', type=float, default=2, help='Seconds per ChatCompletion request')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of requests which fail')
+    parser.add_argument('--slow-rate', type=float, default=0, help='Share of requests which take --slow-latency seconds instead')
+    parser.add_argument('--slow-latency', type=float, default=10, help='Seconds a slow request takes')
+    parser.add_argument('--translator-rpm', type=int, default=0, help='Translator requests per minute, 0 for no limit')
+    parser.add_argument('--speech-rpm', type=int, default=0, help='Speech requests per minute, 0 for no limit')
+    parser.add_argument('--chat-rpm', type=int, default=0, help='ChatCompletion requests per minute, 0 for no limit')
+    parser.add_argument('--chat-tpm', type=int, default=1000000, help='ChatCompletion tokens per minute the client budgets for')
+    parser.add_argument('--audio-format', default='riff-16khz-16bit-mono-pcm')
+    parser.add_argument('--no-chatgpt', dest='chatgpt', action='store_false', help='Leave similar words generation disabled')
+    parser.add_argument('--trad', action='store_true', help='Generate and parse Traditional Chinese')
+    parser.add_argument('--cache', action='store_true', help='Keep the cache enabled, to measure warm runs with --workdir')
+    parser.add_argument('--set', action='append', help='Override any config option, e.g. --set pipeline.text_batch_size=50')
+    parser.add_argument('--dictionary', default='dictionary', help='Dictionary index directory, shared between runs')
+    parser.add_argument('--workdir', help='Directory for config, cache, media and output, a new temporary one by default')
+    parser.add_argument('--json', help='Also write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    directory = args.workdir or tempfile.mkdtemp(prefix='gencards-benchmark-')
+    os.makedirs(directory, exist_ok=True)
+    input_path = args.input or os.path.join(directory, 'input.csv')
+    if args.input is None:
+        generate_input(input_path, args.rows, args.sentence_ratio, args.definition_ratio, args.dictionary, args.trad, args.seed)
+    with open(input_path, encoding='utf-8') as input_file:
+        rows = sum(1 for row in csv.reader(input_file) if len(row) > 0)
+
+    services = FakeServices(latency={'translator': args.translator_latency, 'speech': args.speech_latency, 'chat': args.chat_latency},
+                            error_rate=args.error_rate,
+                            requests_per_minute={'translator': args.translator_rpm, 'speech': args.speech_rpm, 'chat': args.chat_rpm},
+                            seed=args.seed, slow_rate=args.slow_rate, slow_latency=args.slow_latency).install()
+    started = time.perf_counter()
+    result = run_gencards(args, directory, input_path) if args.script == 'gencards' else run_gensents(args, directory, input_path)
+    total_seconds = time.perf_counter() - started
+
+    report = {
+        'script': args.script,
+        'rows': rows,
+        'total_seconds': total_seconds,
+        'rows_per_second': rows / total_seconds if total_seconds > 0 else 0,
+        'services': services.report(),
+        'peak_memory_mb': peak_memory_mb(),
+        'workdir': directory
+    }
+    report.update(result)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(report, json_file, indent=2, ensure_ascii=False)
+    return report
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+class Cache:
+    def __init__(self, path, max_size_mb=500, max_age_days=90, enabled=True):
+        self.enabled = enabled
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+        self.connection = None
+        if enabled:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            ''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+            self.connection.commit()
+
+    @staticmethod
+    def make_key(kind, *parts):
+        # Every setting which changes the result must be part of the key
+        serialised = json.dumps([kind, *parts], ensure_ascii=False)
+        return hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+
+    def get(self, kind, *parts):
+        if not self.enabled:
+            return None
+        key = Cache.make_key(kind, *parts)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.max_age:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+            self.connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+            return row[0]
+
+    def set(self, kind, value, *parts):
+        if not self.enabled:
+            return
+        key = Cache.make_key(kind, *parts)
+        size = len(value.encode('utf-8')) if isinstance(value, str) else len(value)
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO entries (key, kind, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                                    (key, kind, value, size, now, now))
+            self.connection.commit()
+
+    def evict(self):
+        if not self.enabled:
+            return 0
+        with self.lock:
+            expired = self.connection.execute('DELETE FROM entries WHERE created < ?', (time.time() - self.max_age,)).rowcount
+            total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            evicted = 0
+            if total_size > self.max_size:
+                # Least recently used entries go first
+                for key, size in self.connection.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+                    if total_size <= self.max_size:
+                        break
+                    self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    total_size -= size
+                    evicted += 1
+            self.connection.commit()
+        return expired + evicted
+
+    def report(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        if not kinds:
+            return 'Cache: no lookups'
+        lines = ['Cache: {0} hits, {1} misses'.format(sum(self.hits.values()), sum(self.misses.values()))]
+        for kind in kinds:
+            lines.append('  {0}: {1} hits, {2} misses'.format(kind, self.hits.get(kind, 0), self.misses.get(kind, 0)))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.connection is not None:
+            self.evict()
+            self.connection.close()
+            self.connection = None
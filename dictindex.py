@@ -0,0 +1,276 @@
+import argparse
+import array
+import importlib.util
+import mmap
+import os
+import pickle
+import re
+import struct
+import threading
+from dragonmapper import transcriptions
+
+# magic, version, number of entries, longest key in characters
+header = struct.Struct('<4sIII')
+index_magic = b'GCDX'
+index_version = 2
+
+entry_separator = '\x1d'
+definition_separator = '\x1e'
+field_separator = '\x1f'
+
+cedict_pattern = re.compile(r'^(?P<traditional>[^ ]+) (?P<simplified>[^ ]+) \[(?P<pinyin>[^\]]+)\] /(?P<english>.+)/$')
+
+class IndexResult:
+    # Has the same attributes as the results of ChineseAnalyzer's dictionary, so either can be used
+    def __init__(self, match, pinyin, definitions):
+        self.match = match
+        self.pinyin = pinyin
+        self.definitions = definitions
+
+def accented(syllables):
+    words = []
+    for syllable in syllables:
+        try:
+            words.append(transcriptions.numbered_syllable_to_accented(syllable.replace('u:', 'ü')))
+        except ValueError:
+            words.append(syllable)
+    return ''.join(words)
+
+class Segmentation:
+    def __init__(self, index, tokens):
+        self.index = index
+        self.token_list = tokens
+
+    def tokens(self):
+        return list(self.token_list)
+
+    def __getitem__(self, token):
+        return self.index.lookup(token)
+
+    def pinyin(self):
+        # Like ChineseAnalyzer, the first reading of each token
+        words = []
+        for token in self.token_list:
+            result = self.index.lookup(token)[0]
+            words.append(accented(result.pinyin) if result.pinyin is not None else token)
+        return ' '.join(words)
+
+class DictionaryIndex:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.max_key_length = header.unpack_from(self.data, 0)
+        if magic != index_magic or version != index_version:
+            self.close()
+            raise ValueError('Not a current dictionary index: {0}'.format(path))
+        # Record offsets are read straight from the mapped file rather than loaded into memory
+        self.offsets = memoryview(self.data)[header.size:header.size + (self.count + 1) * 4].cast('I')
+
+    def key(self, position):
+        start = self.offsets[position]
+        return self.data[start:self.data.find(b'\t', start, self.offsets[position + 1])]
+
+    def lower_bound(self, key, low=0):
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, word):
+        key = word.encode('utf-8')
+        position = self.lower_bound(key)
+        if position < self.count and self.key(position) == key:
+            return position
+        return None
+
+    def contains(self, word):
+        return self.find(word) is not None
+
+    def lookup(self, word):
+        position = self.find(word) if word else None
+        if position is None:
+            return [IndexResult(word, None, None)] if word else []
+        start = self.offsets[position]
+        record = self.data[start:self.offsets[position + 1]].decode('utf-8')
+        results = []
+        for entry in record[record.index('\t') + 1:].split(entry_separator):
+            pinyin, definitions = entry.split(field_separator)
+            # Words which only come from jieba's or dragonmapper's lists have no definitions, and jieba's no reading either,
+            # the same as a token ChineseAnalyzer can't find in CC-CEDICT
+            results.append(IndexResult(word, pinyin.split(' ') if pinyin else None, definitions.split(definition_separator) if definitions else None))
+        return results
+
+    def longest_match(self, text, start):
+        # Keys sharing a prefix are next to each other, so stop as soon as no key starts with the text so far
+        length = 0
+        low = 0
+        for end in range(start + 1, min(len(text), start + self.max_key_length) + 1):
+            prefix = text[start:end].encode('utf-8')
+            low = self.lower_bound(prefix, low)
+            if low == self.count:
+                break
+            key = self.key(low)
+            if not key.startswith(prefix):
+                break
+            if key == prefix:
+                length = end - start
+        return length
+
+    def tokenize(self, text):
+        # Forward maximum matching, with runs of Latin letters and digits kept together the way jieba does
+        tokens = []
+        i = 0
+        while i < len(text):
+            if text[i].isascii() and text[i].isalnum():
+                length = 1
+                while i + length < len(text) and text[i + length].isascii() and text[i + length].isalnum():
+                    length += 1
+            else:
+                length = self.longest_match(text, i) or 1
+            tokens.append(text[i:i + length])
+            i += length
+        return tokens
+
+    def parse(self, text):
+        return Segmentation(self, self.tokenize(text))
+
+    def close(self):
+        self.offsets = None
+        self.data.close()
+        self.file.close()
+
+def read_cedict(path):
+    traditional = {}
+    simplified = {}
+    with open(path, encoding='utf-8') as cedict_file:
+        for line in cedict_file:
+            match = cedict_pattern.match(line.strip())
+            if match:
+                entry = (match.group('pinyin').split(' '), match.group('english').split('/'))
+                traditional.setdefault(match.group('traditional'), []).append(entry)
+                simplified.setdefault(match.group('simplified'), []).append(entry)
+    return traditional, simplified
+
+def read_bundled_cedict():
+    # The CC-CEDICT copy that comes with the chinese package, which is what ChineseAnalyzer looks words up in
+    directory = importlib.util.find_spec('chinese').submodule_search_locations[0]
+    with open(os.path.join(directory, 'data', 'cedict.pickle'), 'rb') as pickle_file:
+        cedict = pickle.load(pickle_file)
+    dictionaries = []
+    for name in ('traditional', 'simplified'):
+        dictionaries.append({word: [(result.pinyin, result.definitions) for result in results]
+                             for word, results in cedict[name].items() if word != 'name'})
+    add_missing_readings(*dictionaries)
+    return dictionaries
+
+def numbered_syllables(accented_pinyin):
+    from zhon.pinyin import syllable as pinyin_syllable
+    syllables = re.findall(pinyin_syllable, accented_pinyin.replace("'", ' '), re.IGNORECASE)
+    return [transcriptions.accented_syllable_to_numbered(syllable) for syllable in syllables]
+
+def read_dragonmapper_readings(file_name):
+    # Imported here because loading hanzi's own dictionary takes half a second and is only needed to build the index
+    from dragonmapper import hanzi
+    # dragonmapper's own CC-CEDICT word list and Unihan character readings, as (hanzi, accented readings) with the most common reading first
+    directory = importlib.util.find_spec('dragonmapper').submodule_search_locations[0]
+    with open(os.path.join(directory, 'data', file_name), encoding='utf-8') as readings_file:
+        for line in readings_file:
+            word, _, readings = line.rstrip('\n').partition('\t')
+            if all(hanzi.has_chinese(character) for character in word):
+                yield word, readings.split('/')
+
+def add_missing_readings(traditional, simplified):
+    from dragonmapper import hanzi
+    # The copy bundled with the chinese package dropped every CC-CEDICT entry written with u:, e.g. 旅游, 女人 and 绿茶, so
+    # those words were split into single characters. They are added back without definitions, as are the ü readings of characters such as 女.
+    for file_name in ('hanzi_pinyin_words.tsv', 'hanzi_pinyin_characters.tsv'):
+        for word, readings in read_dragonmapper_readings(file_name):
+            has_u = re.search('[üǖǘǚǜ]', ''.join(readings)) is not None
+            if len(word) == 1 and not has_u:
+                continue
+            identity = hanzi.identify(word)
+            dictionaries = [dictionary for dictionary, scripts in ((traditional, (hanzi.TRADITIONAL, hanzi.BOTH)), (simplified, (hanzi.SIMPLIFIED, hanzi.BOTH)))
+                            if identity in scripts and (has_u or word not in dictionary)]
+            if not dictionaries:
+                continue
+            readings = [syllables for syllables in map(numbered_syllables, readings) if len(syllables) == len(word)]
+            if len(word) == 1:
+                readings = [syllables for syllables in readings if 'ü' in syllables[0]]
+            for dictionary in dictionaries:
+                entries = dictionary.get(word, [])
+                known = set(' '.join(pinyin).replace('u:', 'ü').lower() for pinyin, definitions in entries)
+                missing = [(syllables, []) for syllables in readings if ' '.join(syllables).lower() not in known]
+                if not missing:
+                    continue
+                # A character whose most common reading was dropped, like 女, gets it back in first place
+                dictionary[word] = missing + entries if len(word) == 1 and readings[0] == missing[0][0] else entries + missing
+
+def add_jieba_words(dictionary, is_trad):
+    # ChineseAnalyzer splits text with jieba, whose vocabulary has many common words CC-CEDICT doesn't, e.g. 很多 and 看到.
+    # They're kept whole here too, so a row is a word or a sentence the same way with either.
+    directory = importlib.util.find_spec('jieba').submodule_search_locations[0]
+    path = os.path.join(importlib.util.find_spec('chinese').submodule_search_locations[0], 'data', 'dict.txt.big') if is_trad else os.path.join(directory, 'dict.txt')
+    with open(path, encoding='utf-8') as jieba_file:
+        for line in jieba_file:
+            word = line.split(' ')[0]
+            if len(word) > 1 and not any(character.isascii() for character in word) and word not in dictionary:
+                dictionary[word] = [([], [])]
+
+def write_index(path, dictionary):
+    keys = sorted(dictionary, key=lambda word: word.encode('utf-8'))
+    records = []
+    for word in keys:
+        entries = entry_separator.join(' '.join(pinyin) + field_separator + definition_separator.join(definitions)
+                                       for pinyin, definitions in dictionary[word])
+        records.append((word + '\t' + entries).encode('utf-8'))
+    offsets = array.array('I')
+    position = header.size + (len(records) + 1) * offsets.itemsize
+    for record in records:
+        offsets.append(position)
+        position += len(record)
+    offsets.append(position)
+
+    # Unique to the process and thread, since sharded runs can all find the index missing and build it at once
+    temporary_path = '{0}.tmp-{1}-{2}'.format(path, os.getpid(), threading.get_ident())
+    with open(temporary_path, 'wb') as index_file:
+        index_file.write(header.pack(index_magic, index_version, len(records), max((len(word) for word in keys), default=0)))
+        index_file.write(offsets.tobytes())
+        for record in records:
+            index_file.write(record)
+    os.replace(temporary_path, path)
+
+def index_path(directory, is_trad):
+    return os.path.join(directory, 'cedict-traditional.idx' if is_trad else 'cedict-simplified.idx')
+
+def build_indexes(directory, source=None):
+    os.makedirs(directory, exist_ok=True)
+    traditional, simplified = read_cedict(source) if source is not None else read_bundled_cedict()
+    add_jieba_words(traditional, True)
+    add_jieba_words(simplified, False)
+    write_index(index_path(directory, True), traditional)
+    write_index(index_path(directory, False), simplified)
+
+build_lock = threading.Lock()
+
+def load_index(directory, is_trad):
+    path = index_path(directory, is_trad)
+    with build_lock:
+        try:
+            return DictionaryIndex(path)
+        except (OSError, ValueError):
+            build_indexes(directory)
+    return DictionaryIndex(path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the simplified and traditional dictionary indexes used by gencards and gensents.')
+    parser.add_argument('--output', default='dictionary', help='Directory to write the indexes to, the dictionary_index_path option')
+    parser.add_argument('--source', help='A CC-CEDICT cedict_ts.u8 file, defaults to the copy bundled with the chinese package')
+    args = parser.parse_args(argv)
+    build_indexes(args.output, args.source)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import datetime
+import io
+import json
+import random
+import re
+import threading
+import time
+import wave
+from ratelimit import TokenBucket
+from speechbatch import sample_rate
+
+# Local stand-ins for Azure Translator, Azure Speech and OpenAI ChatCompletion, so runs can be measured without a network.
+# install() swaps them into the real SDK modules, which keeps the SDK's own error types and constants.
+
+class FakeObject:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+class FakeServices:
+    def __init__(self, latency=None, error_rate=0, requests_per_minute=None, seed=None, slow_rate=0, slow_latency=0):
+        # latency and requests_per_minute map a service name, translator, speech or chat, to seconds and a limit
+        self.latency = latency or {}
+        self.error_rate = error_rate
+        # A share of requests which take slow_latency seconds instead, to reproduce a long latency tail
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.limits = {service: TokenBucket(limit) for service, limit in (requests_per_minute or {}).items() if limit}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.items = {}
+        self.characters = {}
+        self.errors = {}
+        self.throttled = {}
+        self.slow = {}
+
+    def record(self, counts, name, amount=1):
+        with self.lock:
+            counts[name] = counts.get(name, 0) + amount
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def sleep(self, service):
+        with self.lock:
+            is_slow = self.random.random() < self.slow_rate
+        latency = self.slow_latency if is_slow else self.latency.get(service, 0)
+        if is_slow:
+            self.record(self.slow, service)
+        if latency:
+            time.sleep(latency)
+
+    def throttle(self, service):
+        # Returns how long the caller has to wait before the service would accept another request
+        bucket = self.limits.get(service)
+        if bucket is None:
+            return 0
+        with self.lock:
+            wait = bucket.wait_time(1, time.monotonic())
+            if wait <= 0:
+                bucket.take(1)
+        return wait
+
+    def wait(self, service):
+        # The Azure SDKs retry throttled requests themselves, so callers only see the delay
+        while True:
+            wait = self.throttle(service)
+            if wait <= 0:
+                break
+            self.record(self.throttled, service)
+            time.sleep(wait)
+        self.sleep(service)
+
+    def translator_call(self, name, content):
+        from azure.core.exceptions import HttpResponseError
+        self.wait('translator')
+        self.record(self.calls, name)
+        self.record(self.items, name, len(content))
+        self.record(self.characters, name, sum(len(item.text) for item in content))
+        if self.should_fail():
+            self.record(self.errors, name)
+            raise HttpResponseError(message='Fake translator error')
+
+    def translator(self):
+        services = self
+
+        class FakeTextTranslationClient:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def translate(self, content, **kwargs):
+                services.translator_call('translate', content)
+                return [FakeObject(translations=[FakeObject(text='meaning of ' + item.text)]) for item in content]
+
+            def transliterate(self, content, **kwargs):
+                from dragonmapper import hanzi
+                services.translator_call('transliterate', content)
+                results = []
+                for item in content:
+                    try:
+                        reading = hanzi.to_pinyin(item.text)
+                    except Exception:
+                        reading = item.text
+                    results.append(FakeObject(text=reading))
+                return results
+
+        return FakeTextTranslationClient
+
+    def speak(self, text, audio_format, bookmark_handlers=()):
+        import azure.cognitiveservices.speech as speechsdk
+        self.wait('speech')
+        self.record(self.calls, 'speech')
+        self.record(self.characters, 'speech', len(re.sub(r'<[^>]*>', '', text)))
+        if self.should_fail():
+            self.record(self.errors, 'speech')
+            return FakeObject(reason=speechsdk.ResultReason.Canceled,
+                              cancellation_details=FakeObject(error_details='Fake speech error'))
+        # 0.2 seconds a character plus any breaks, with bookmark events at the offsets they'd be reached
+        duration = 0
+        for tag, content in re.findall(r'(<[^>]*>)|([^<]+)', text):
+            mark = re.match(r'<bookmark mark="([^"]*)"', tag)
+            pause = re.match(r'<break time="(\d+)ms"', tag)
+            if mark:
+                for handler in bookmark_handlers:
+                    handler(FakeObject(text=mark.group(1), audio_offset=int(duration * 10000000)))
+            elif pause:
+                duration += int(pause.group(1)) / 1000
+            elif content:
+                duration += 0.2 * len(content)
+        duration = max(0.2, duration)
+        return FakeObject(reason=speechsdk.ResultReason.SynthesizingAudioCompleted,
+                          audio_data=fake_audio(audio_format, duration),
+                          audio_duration=datetime.timedelta(seconds=duration))
+
+    def speech(self):
+        services = self
+
+        class FakeSpeechConfig:
+            def __init__(self, *args, **kwargs):
+                self.speech_synthesis_voice_name = None
+                self.audio_format = 'riff-16khz-16bit-mono-pcm'
+
+            def set_property(self, property_id, value):
+                self.audio_format = value
+
+        class FakeResultFuture:
+            def __init__(self, get):
+                self.get = get
+
+        class FakeEventSignal:
+            def __init__(self):
+                self.handlers = []
+
+            def connect(self, handler):
+                self.handlers.append(handler)
+
+        class FakeSpeechSynthesizer:
+            def __init__(self, speech_config=None, audio_config=None):
+                self.speech_config = speech_config
+                self.bookmark_reached = FakeEventSignal()
+
+            def speak_text_async(self, text):
+                return FakeResultFuture(lambda: services.speak(text, self.speech_config.audio_format))
+
+            def speak_ssml_async(self, ssml):
+                return FakeResultFuture(lambda: services.speak(ssml, self.speech_config.audio_format, self.bookmark_reached.handlers))
+
+        class FakeAudioDataStream:
+            def __init__(self, result):
+                self.result = result
+
+            def save_to_wav_file(self, path):
+                with open(path, 'wb') as audio_file:
+                    audio_file.write(self.result.audio_data)
+
+        return FakeSpeechConfig, FakeSpeechSynthesizer, FakeAudioDataStream
+
+    def chat_completion(self, model, messages, **kwargs):
+        import openai
+        throttled = self.throttle('chat')
+        if throttled > 0:
+            self.record(self.throttled, 'chat')
+            raise openai.error.RateLimitError('Fake rate limit reached', headers={'retry-after': str(throttled)})
+        self.sleep('chat')
+        self.record(self.calls, 'chat')
+        prompt = messages[-1]['content']
+        if self.should_fail():
+            self.record(self.errors, 'chat')
+            raise openai.error.ServiceUnavailableError('Fake chat error')
+        content = fake_chat_reply(prompt)
+        prompt_tokens = sum(len(message['content']) for message in messages)
+        self.record(self.characters, 'chat_prompt_tokens', prompt_tokens)
+        self.record(self.characters, 'chat_completion_tokens', len(content))
+        return FakeObject(choices=[FakeObject(message=FakeObject(content=content))],
+                          usage={'prompt_tokens': prompt_tokens, 'completion_tokens': len(content), 'total_tokens': prompt_tokens + len(content)})
+
+    def install(self):
+        import azure.ai.translation.text as translation
+        import azure.cognitiveservices.speech as speechsdk
+        import openai
+        translation.TextTranslationClient = self.translator()
+        translation.TranslatorCredential = lambda *args, **kwargs: None
+        speechsdk.SpeechConfig, speechsdk.SpeechSynthesizer, speechsdk.AudioDataStream = self.speech()
+        openai.ChatCompletion = FakeObject(create=self.chat_completion)
+        return self
+
+    def report(self):
+        return {
+            'calls': dict(self.calls),
+            'items': dict(self.items),
+            'characters': dict(self.characters),
+            'errors': dict(self.errors),
+            'throttled': dict(self.throttled),
+            'slow': dict(self.slow)
+        }
+
+def fake_audio(audio_format, duration):
+    rate = sample_rate(audio_format)
+    if audio_format.startswith('riff') or audio_format.startswith('raw'):
+        audio = io.BytesIO()
+        with wave.open(audio, 'wb') as wave_file:
+            wave_file.setnchannels(1)
+            wave_file.setsampwidth(2)
+            wave_file.setframerate(rate)
+            wave_file.writeframes(bytes(int(rate * duration) * 2))
+        return audio.getvalue()
+    bitrate = re.search(r'(\d+)kbitrate', audio_format)
+    # Opus and mp3 at their usual bitrates, without a real encoder
+    return bytes(int((int(bitrate.group(1)) if bitrate else 32) * 125 * duration))
+
+def fake_chat_reply(prompt):
+    words = re.findall(r'[㐀-鿿]+', prompt[prompt.rindex('Words:'):] if 'Words:' in prompt else prompt)
+    if 'JSON' in prompt:
+        words = json.loads(prompt[prompt.index('Words: ') + 7:])
+        return json.dumps({word: [[word + '們', 'men', 'related to ' + word]] * 5 for word in words}, ensure_ascii=False)
+    if 'example sentences' in prompt:
+        return '\n'.join('我很喜歡{0}.|wǒ hěn xǐ huān.|I like {0}.'.format(word) for word in words for _ in range(2))
+    return '\n'.join('{0}們,men,related to {0}'.format(word) for word in words[-1:] * 5)
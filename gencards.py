@@ -3,189 +3,356 @@ import genanki
 import configparser
 import random
 import time
-from chinese import ChineseAnalyzer
-from dragonmapper import transcriptions, hanzi
+from dragonmapper import transcriptions
 import csv
-from azure.ai.translation.text import TextTranslationClient, TranslatorCredential
-from azure.ai.translation.text.models import InputTextItem
-import azure.cognitiveservices.speech as speechsdk
+import argparse
 import pathlib
-import unicodedata
-import re
 import os
-import shutil
-import openai
 from io import StringIO
 import logging
+import json
+import threading
+import asyncio
+import math
+import datetime
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from cache import Cache
+from mediastore import MediaStore
+from batching import make_batches
+from pipeline import Stage, run_pipeline
+from manifest import row_hash, load_manifest, save_manifest
+from ratelimit import create_chat_completion, rate_limiter_from_config
+from dictindex import load_index
+from metrics import Metrics
+from journal import Journal
+from speechbatch import batch_ssml, is_splittable, read_pcm, sample_rate, split_clips, write_wav
+from hedging import CallPolicy
+from ankicollection import read_existing_hanzi
+
+# The Azure and OpenAI SDKs and the Chinese dictionaries are slow to import,
+# so they are imported where they are first needed rather than here
+
+logger = logging.getLogger('gencards')
+
+class SynthesisError(Exception):
+    pass
 
 def generate_id():
     return str(random.randrange(1 << 30, 1 << 31))
 
-config = configparser.ConfigParser()
+def required_option(section, option):
+    # Keys are left unset when the config was loaded without a terminal to ask for them
+    if not section.get(option):
+        raise ValueError('{0} is missing from the {1} section of the config, run the script from a terminal to be asked for it or add it to the config file'.format(option, section.name))
+    return section.get(option)
 
-config.read('config.ini')
+def load_config(path='config.ini', interactive=True):
+    config = configparser.ConfigParser()
 
-if not config.has_section('model'):
-    config.add_section('model')
+    config.read(path)
 
-model_config = config['model']
+    if not config.has_section('model'):
+        config.add_section('model')
 
-if not config.has_option('model', 'deck_id'):
-    config['model']['deck_id'] = generate_id()
+    if not config.has_option('model', 'deck_id'):
+        config['model']['deck_id'] = generate_id()
 
-if not config.has_option('model', 'word_model_id'):
-    config['model']['word_model_id'] = generate_id()
+    if not config.has_option('model', 'word_model_id'):
+        config['model']['word_model_id'] = generate_id()
 
-if not config.has_option('model', 'sentence_model_id'):
-    config['model']['sentence_model_id'] = generate_id()
+    if not config.has_option('model', 'sentence_model_id'):
+        config['model']['sentence_model_id'] = generate_id()
 
-if not config.has_section('azure'):
-    config.add_section('azure')
+    if not config.has_section('azure'):
+        config.add_section('azure')
 
-azure_config = config['azure']
+    # Without a terminal the keys are left unset, and creating the client which needs them raises a ValueError
+    if interactive:
+        if not config.has_option('azure', 'translator_api_key'):
+            print('Missing Microsoft Azure Translator Config. See here: https://learn.microsoft.com/en-us/azure/cognitive-services/translator/text-sdk-overview?tabs=python')
+            config['azure']['translator_api_key'] = input('Translator API Key: ')
 
-if not config.has_option('azure', 'translator_api_key'):
-    print('Missing Microsoft Azure Translator Config. See here: https://learn.microsoft.com/en-us/azure/cognitive-services/translator/text-sdk-overview?tabs=python')
-    config['azure']['translator_api_key'] = input('Translator API Key: ')
+        if not config.has_option('azure', 'translator_api_endpoint'):
+            print('Missing Microsoft Azure Translator Config. See here: https://learn.microsoft.com/en-us/azure/cognitive-services/translator/text-sdk-overview?tabs=python')
+            config['azure']['translator_api_endpoint'] = input('Translator API Endpoint: ')
 
-if not config.has_option('azure', 'translator_api_endpoint'):
-    print('Missing Microsoft Azure Translator Config. See here: https://learn.microsoft.com/en-us/azure/cognitive-services/translator/text-sdk-overview?tabs=python')
-    config['azure']['translator_api_endpoint'] = input('Translator API Endpoint: ')
+        if not config.has_option('azure', 'speech_api_key'):
+            print('Missing Microsoft Azure Speech Config. See here: https://learn.microsoft.com/en-GB/azure/cognitive-services/speech-service/get-started-text-to-speech?tabs=windows%2Cterminal&pivots=programming-language-python')
+            config['azure']['speech_api_key'] = input('Speech API Key: ')
 
-if not config.has_option('azure', 'speech_api_key'):
-    print('Missing Microsoft Azure Speech Config. See here: https://learn.microsoft.com/en-GB/azure/cognitive-services/speech-service/get-started-text-to-speech?tabs=windows%2Cterminal&pivots=programming-language-python')
-    config['azure']['speech_api_key'] = input('Speech API Key: ')
+        if not config.has_option('azure', 'speech_api_endpoint'):
+            print('Missing Microsoft Azure Speech Config. See here: https://learn.microsoft.com/en-GB/azure/cognitive-services/speech-service/get-started-text-to-speech?tabs=windows%2Cterminal&pivots=programming-language-python')
+            config['azure']['speech_api_endpoint'] = input('Speech API Endpoint: ')
 
-if not config.has_option('azure', 'speech_api_endpoint'):
-    print('Missing Microsoft Azure Speech Config. See here: https://learn.microsoft.com/en-GB/azure/cognitive-services/speech-service/get-started-text-to-speech?tabs=windows%2Cterminal&pivots=programming-language-python')
-    config['azure']['speech_api_endpoint'] = input('Speech API Endpoint: ')
+        if not config.has_option('azure', 'region'):
+            print('Missing Microsoft Azure Config. See here: https://learn.microsoft.com/en-us/azure/cognitive-services/translator/text-sdk-overview?tabs=python')
+            config['azure']['region'] = input('Azure Region: ')
 
-if not config.has_option('azure', 'region'):
-    print('Missing Microsoft Azure Config. See here: https://learn.microsoft.com/en-us/azure/cognitive-services/translator/text-sdk-overview?tabs=python')
-    config['azure']['region'] = input('Azure Region: ')
+    if not config.has_option('azure', 'speech_api_voice_name'):
+        config['azure']['speech_api_voice_name'] = 'zh-TW-YunJheNeural'
 
-if not config.has_option('azure', 'speech_api_voice_name'):
-    config['azure']['speech_api_voice_name'] = 'zh-TW-YunJheNeural'
+    if not config.has_option('azure', 'speech_concurrency'):
+        config['azure']['speech_concurrency'] = '4'
 
-if not config.has_section('mandarin'):
-    config.add_section('mandarin')
+    if not config.has_option('azure', 'speech_batch_size'):
+        config['azure']['speech_batch_size'] = '1'
 
-mandarin_config = config['mandarin']
+    if not config.has_option('azure', 'translator_timeout'):
+        config['azure']['translator_timeout'] = '30'
 
-if not config.has_option('mandarin', 'is_trad'):
-    config['mandarin']['is_trad'] = 'false'
+    if not config.has_option('azure', 'speech_timeout'):
+        config['azure']['speech_timeout'] = '60'
 
-if not config.has_option('mandarin', 'reading_format'):
-    config['mandarin']['reading_format'] = 'pinyin'
+    if not config.has_option('azure', 'max_retries'):
+        config['azure']['max_retries'] = '2'
 
-is_trad = mandarin_config.getboolean('is_trad')
-reading_format = mandarin_config.get('reading_format')
+    if not config.has_option('azure', 'is_hedging_enabled'):
+        config['azure']['is_hedging_enabled'] = 'false'
 
-if not config.has_section('openai'):
-    config.add_section('openai')
+    if not config.has_option('azure', 'hedge_percentile'):
+        config['azure']['hedge_percentile'] = '95'
 
-openai_config = config['openai']
+    if not config.has_option('azure', 'speech_audio_format'):
+        config['azure']['speech_audio_format'] = 'riff-16khz-16bit-mono-pcm'
 
-if not config.has_option('openai', 'is_chatgpt_enabled'):
-    config['openai']['is_chatgpt_enabled'] = 'false'
+    if not config.has_section('mandarin'):
+        config.add_section('mandarin')
 
-is_chatgpt_enabled = openai_config.getboolean('is_chatgpt_enabled')
+    if not config.has_option('mandarin', 'is_trad'):
+        config['mandarin']['is_trad'] = 'false'
 
-if is_chatgpt_enabled:
-    if not config.has_option('openai', 'api_key'):
-        print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
-        config['openai']['api_key'] = input('OpenAi API Key: ')
+    if not config.has_option('mandarin', 'reading_format'):
+        config['mandarin']['reading_format'] = 'pinyin'
 
-    if not config.has_option('openai', 'organisation'):
-        print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
-        config['openai']['organisation'] = input('Organisation ID: ')
+    if not config.has_option('mandarin', 'is_local_reading_enabled'):
+        config['mandarin']['is_local_reading_enabled'] = 'true'
 
-with open('config.ini', 'w') as configfile:
-    config.write(configfile)
+    if not config.has_option('mandarin', 'is_dictionary_index_enabled'):
+        config['mandarin']['is_dictionary_index_enabled'] = 'true'
 
-translator_credential = TranslatorCredential(azure_config.get('translator_api_key'), azure_config.get('region'))
-text_translator = TextTranslationClient(endpoint=azure_config.get('translator_api_endpoint'), credential=translator_credential)
+    if not config.has_option('mandarin', 'dictionary_index_path'):
+        config['mandarin']['dictionary_index_path'] = 'dictionary'
 
-speech_config = speechsdk.SpeechConfig(subscription=azure_config.get('speech_api_key'), region=azure_config.get('region'))
-speech_config.speech_synthesis_voice_name = azure_config.get('speech_api_voice_name')
-if is_chatgpt_enabled:
-    openai.organization = openai_config.get('organisation')
-    openai.api_key = openai_config.get('api_key')
+    if not config.has_section('openai'):
+        config.add_section('openai')
 
-logger = logging.getLogger('gencards')
-logger.setLevel(logging.DEBUG)
-
-stdout = logging.StreamHandler(sys.stdout)
-stdout.setLevel(logging.INFO)
-
-errlogfile = logging.FileHandler('errlog.txt', mode='w', encoding='utf-8')
-errlogfile.setLevel(logging.ERROR)
-
-logfile = logging.FileHandler('log.txt', mode='w', encoding='utf-8')
-logfile.setLevel(logging.DEBUG)
-
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-errlogfile.setFormatter(formatter)
-logfile.setFormatter(formatter)
-
-logger.addHandler(stdout)
-logger.addHandler(errlogfile)
-logger.addHandler(logfile)
-
-deck = genanki.Deck(
-    model_config.getint('deck_id'),
-    'Generated Mandarin Flashcards'
-)
-
-word_model = genanki.Model(
-    model_config.getint('word_model_id'),
-    'Mandarin Word',
-    fields=[
-        {'name': 'timestamp'},
-        {'name': 'Hanzi'},
-        {'name': 'Definition'},
-        {'name': 'Audio'},
-        {'name': 'Reading'},
-        {'name': 'Similar Words'}
-    ],
-    templates=[
-        {
-            'name': 'Listening',
-            'qfmt': 'Listen.{{Audio}}',
-            'afmt': '''
-                {{FrontSide}}
-                <hr id=answer>
-                {{Hanzi}}<br>{{Reading}}<br>{{Definition}}
-                <hr id=answer>
-                {{Similar Words}}
-            '''
-        },
-        {
-            'name': 'Reading',
-            'qfmt': '{{Hanzi}}',
-            'afmt': '''
-                {{FrontSide}}
-                <hr id=answer>
-                {{Reading}}<br>{{Definition}}<br>{{Audio}}
-                <hr id=answer>
-                {{Similar Words}}
-            '''
-        }
-    ],
-    css='''
-        .card {
-            font-family: arial;
-            font-size: 20px;
-            text-align: center;
-            color: black;
-            background-color: white;
-        }
-    '''
-)
-deck.add_model(word_model)
+    if not config.has_option('openai', 'is_chatgpt_enabled'):
+        config['openai']['is_chatgpt_enabled'] = 'false'
+
+    if config['openai'].getboolean('is_chatgpt_enabled') and interactive:
+        if not config.has_option('openai', 'api_key'):
+            print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
+            config['openai']['api_key'] = input('OpenAi API Key: ')
+
+        if not config.has_option('openai', 'organisation'):
+            print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
+            config['openai']['organisation'] = input('Organisation ID: ')
+
+    if not config.has_option('openai', 'requests_per_minute'):
+        config['openai']['requests_per_minute'] = '3'
+
+    if not config.has_option('openai', 'tokens_per_minute'):
+        config['openai']['tokens_per_minute'] = '40000'
+
+    if not config.has_option('openai', 'max_retries'):
+        config['openai']['max_retries'] = '5'
+
+    if not config.has_option('openai', 'request_timeout'):
+        config['openai']['request_timeout'] = '120'
+
+    if not config.has_option('openai', 'similar_words_batch_size'):
+        config['openai']['similar_words_batch_size'] = '10'
+
+    if not config.has_section('pipeline'):
+        config.add_section('pipeline')
+
+    if not config.has_option('pipeline', 'queue_size'):
+        config['pipeline']['queue_size'] = '100'
+
+    if not config.has_option('pipeline', 'parse_concurrency'):
+        config['pipeline']['parse_concurrency'] = '1'
+
+    if not config.has_option('pipeline', 'text_concurrency'):
+        config['pipeline']['text_concurrency'] = '2'
+
+    if not config.has_option('pipeline', 'text_batch_size'):
+        config['pipeline']['text_batch_size'] = '100'
+
+    if not config.has_option('pipeline', 'similar_words_concurrency'):
+        config['pipeline']['similar_words_concurrency'] = '2'
+
+    if not config.has_option('pipeline', 'similar_words_batch_wait'):
+        config['pipeline']['similar_words_batch_wait'] = '2'
+
+    if not config.has_option('pipeline', 'speech_batch_wait'):
+        config['pipeline']['speech_batch_wait'] = '1'
+
+    if not config.has_option('pipeline', 'retry_attempts'):
+        config['pipeline']['retry_attempts'] = '3'
+
+    if not config.has_option('pipeline', 'retry_delay'):
+        config['pipeline']['retry_delay'] = '5'
+
+    if not config.has_option('pipeline', 'processes'):
+        config['pipeline']['processes'] = '1'
+
+    if not config.has_section('incremental'):
+        config.add_section('incremental')
+
+    if not config.has_option('incremental', 'is_incremental_enabled'):
+        config['incremental']['is_incremental_enabled'] = 'false'
+
+    if not config.has_option('incremental', 'manifest_path'):
+        config['incremental']['manifest_path'] = 'manifest.json'
+
+    if not config.has_option('incremental', 'output_mode'):
+        config['incremental']['output_mode'] = 'full'
+
+    if not config.has_section('cache'):
+        config.add_section('cache')
+
+    if not config.has_option('cache', 'is_cache_enabled'):
+        config['cache']['is_cache_enabled'] = 'true'
+
+    if not config.has_option('cache', 'path'):
+        config['cache']['path'] = 'cache.sqlite'
+
+    if not config.has_option('cache', 'max_size_mb'):
+        config['cache']['max_size_mb'] = '500'
+
+    if not config.has_option('cache', 'max_age_days'):
+        config['cache']['max_age_days'] = '90'
+
+    if not config.has_option('cache', 'media_path'):
+        config['cache']['media_path'] = 'media'
+
+    if not config.has_option('cache', 'media_max_size_mb'):
+        config['cache']['media_max_size_mb'] = '2000'
+
+    if not config.has_option('cache', 'media_max_age_days'):
+        config['cache']['media_max_age_days'] = '90'
+
+    if not config.has_section('checkpoint'):
+        config.add_section('checkpoint')
+
+    if not config.has_option('checkpoint', 'is_checkpoint_enabled'):
+        config['checkpoint']['is_checkpoint_enabled'] = 'true'
+
+    if not config.has_option('checkpoint', 'journal_path'):
+        config['checkpoint']['journal_path'] = 'journal.jsonl'
+
+    if not config.has_section('metrics'):
+        config.add_section('metrics')
+
+    if not config.has_option('metrics', 'is_metrics_enabled'):
+        config['metrics']['is_metrics_enabled'] = 'true'
+
+    if not config.has_option('metrics', 'path'):
+        config['metrics']['path'] = 'metrics.json'
+
+    if not config.has_section('collection'):
+        config.add_section('collection')
+
+    if not config.has_option('collection', 'is_collection_enabled'):
+        config['collection']['is_collection_enabled'] = 'false'
+
+    if not config.has_option('collection', 'path'):
+        config['collection']['path'] = 'collection.anki2'
+
+    if not config.has_section('server'):
+        config.add_section('server')
+
+    if not config.has_option('server', 'host'):
+        config['server']['host'] = '127.0.0.1'
+
+    if not config.has_option('server', 'port'):
+        config['server']['port'] = '8765'
+
+    if not config.has_option('server', 'socket_path'):
+        config['server']['socket_path'] = ''
+
+    if not config.has_option('server', 'max_jobs'):
+        config['server']['max_jobs'] = '2'
+
+    if not config.has_option('server', 'output_path'):
+        config['server']['output_path'] = 'decks'
+
+    with open(path, 'w') as configfile:
+        config.write(configfile)
+
+    return config
 
-sentence_model = genanki.Model(
-        model_config.getint('sentence_model_id'),
+def setup_logging():
+    logger.setLevel(logging.DEBUG)
+
+    stdout = logging.StreamHandler(sys.stdout)
+    stdout.setLevel(logging.INFO)
+
+    errlogfile = logging.FileHandler('errlog.txt', mode='w', encoding='utf-8')
+    errlogfile.setLevel(logging.ERROR)
+
+    logfile = logging.FileHandler('log.txt', mode='w', encoding='utf-8')
+    logfile.setLevel(logging.DEBUG)
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    errlogfile.setFormatter(formatter)
+    logfile.setFormatter(formatter)
+
+    logger.addHandler(stdout)
+    logger.addHandler(errlogfile)
+    logger.addHandler(logfile)
+
+def build_word_model(model_id):
+    return genanki.Model(
+        model_id,
+        'Mandarin Word',
+        fields=[
+            {'name': 'timestamp'},
+            {'name': 'Hanzi'},
+            {'name': 'Definition'},
+            {'name': 'Audio'},
+            {'name': 'Reading'},
+            {'name': 'Similar Words'}
+        ],
+        templates=[
+            {
+                'name': 'Listening',
+                'qfmt': 'Listen.{{Audio}}',
+                'afmt': '''
+                    {{FrontSide}}
+                    <hr id=answer>
+                    {{Hanzi}}<br>{{Reading}}<br>{{Definition}}
+                    <hr id=answer>
+                    {{Similar Words}}
+                '''
+            },
+            {
+                'name': 'Reading',
+                'qfmt': '{{Hanzi}}',
+                'afmt': '''
+                    {{FrontSide}}
+                    <hr id=answer>
+                    {{Reading}}<br>{{Definition}}<br>{{Audio}}
+                    <hr id=answer>
+                    {{Similar Words}}
+                '''
+            }
+        ],
+        css='''
+            .card {
+                font-family: arial;
+                font-size: 20px;
+                text-align: center;
+                color: black;
+                background-color: white;
+            }
+        '''
+    )
+
+def build_sentence_model(model_id):
+    return genanki.Model(
+        model_id,
         'Mandarin Sentence',
         fields=[
             {'name': 'timestamp'},
@@ -228,230 +395,1064 @@ sentence_model = genanki.Model(
             }
         '''
     )
-deck.add_model(sentence_model)
-
-try: #Make tmp directory if not exists
-    os.makedirs('tmp')
-except OSError as e:
-    e
-media_files = []
-
-analyser = ChineseAnalyzer()
-
-def build_word(hanzi, definition, audio, reading, similar_words):
-    word_note = genanki.Note(
-                    model=word_model,
-                    fields=[
-                        str(time.time_ns()),
-                        hanzi,
-                        definition,
-                        audio,
-                        reading,
-                        similar_words
-                    ]
-                )
-    
-    return word_note
-
-def build_sentence(hanzi, definition, audio, reading):
-    sentence_note = genanki.Note(
-                    model=sentence_model,
-                    fields=[
-                        str(time.time_ns()),
-                        hanzi,
-                        definition,
-                        audio,
-                        reading
-                    ]
-                )
-    
-    return sentence_note
-
-def transliterate_hanzi(hanzi):
-    logger.debug('Transliterating Hanzi')
-    language = 'zh-Hant' if is_trad else 'zh-Hans'
-    from_script = 'Hant' if is_trad else 'Hans'
-    to_script = 'Latn'
-    text_to_transliterate = [InputTextItem(text = hanzi)]
-
-    transliteration_response = text_translator.transliterate(content=text_to_transliterate,
-                                                                            language=language,
-                                                                            from_script=from_script,
-                                                                            to_script=to_script)
-    transliteration = transliteration_response[0]
-    reading = transliteration.text
-    if reading_format == 'zhuyin':
+
+def note_guid(model, hanzi):
+    # Derived from the Hanzi alone so a rebuilt note keeps its identity in Anki
+    return genanki.guid_for(model.name, hanzi)
+
+# Per request limits of the Azure Translator API
+translate_max_items = 1000
+translate_max_chars = 50000
+transliterate_max_items = 10
+transliterate_max_chars = 5000
+
+chatgpt_model = 'gpt-3.5-turbo'
+similar_words_prompt_version = 1
+similar_words_batch_prompt_version = 'batch-1'
+
+# Resources a daemon keeps warm between jobs, with the settings each one depends on, so jobs only share them when those match.
+# Anything else, e.g. the manifest and journal, belongs to a single job.
+shareable_resources = {
+    'text_translator': (),
+    'speech_config': ('voice_name', 'audio_format'),
+    'idle_synthesizers': ('voice_name', 'audio_format'),
+    'synthesis_pool': (),
+    'rate_limiter': (),
+    'analyser': (),
+    'dictionary_index': ('is_trad',),
+    'cache': (),
+    'media_store': (),
+    'word_model': (),
+    'sentence_model': ()
+}
+
+def audio_extension(audio_format):
+    # Only PCM is saved as wav, a mu-law, a-law or SILK stream under a wav header wouldn't play
+    if (audio_format.startswith('riff') or audio_format.startswith('raw')) and audio_format.endswith('pcm'):
+        return '.wav'
+    if audio_format.startswith('ogg') and audio_format.endswith('opus'):
+        return '.ogg'
+    if audio_format.startswith('webm') and audio_format.endswith('opus'):
+        return '.webm'
+    if audio_format.startswith('audio') and audio_format.endswith('mp3'):
+        return '.mp3'
+    raise ValueError('Unsupported speech_audio_format: {0}'.format(audio_format))
+
+def pcm_size(audio_format, duration):
+    # What the same audio would take as 16 bit mono PCM, to report the saving from compression
+    return int(duration.total_seconds() * sample_rate(audio_format) * 2)
+
+def is_retryable(future):
+    # Nothing submitted yet, or the last request raised, e.g. timed out, so a deferred row gets a new one
+    return future is None or (future.done() and future.exception() is not None)
+
+def sound_tag(path):
+    return '[sound:' + os.path.basename(path) + ']' if path is not None else ''
+
+def find_all(source_string, search_char):
+    return [i for i, character in enumerate(source_string) if character == search_char]
+
+def is_built(entry):
+    return entry['is_built']
+
+def is_skipped(entry):
+    # Rows which failed an earlier stage for good aren't worth sending to any later service
+    return entry['is_built'] or entry['is_failed']
+
+def read_input_rows(path):
+    with open(path, encoding='utf-8') as input_file:
+        linereader = csv.reader(input_file, skipinitialspace=True)
+        for row in linereader:
+            if len(row) > 0:
+                yield row
+
+class CardGenerator:
+    def __init__(self, config, shared=None):
+        self.config = config
+        self.model_config = config['model']
+        self.azure_config = config['azure']
+        self.mandarin_config = config['mandarin']
+        self.openai_config = config['openai']
+        self.pipeline_config = config['pipeline']
+        self.incremental_config = config['incremental']
+        self.cache_config = config['cache']
+        self.metrics_config = config['metrics']
+        self.checkpoint_config = config['checkpoint']
+        self.collection_config = config['collection']
+
+        self.is_trad = self.mandarin_config.getboolean('is_trad')
+        self.reading_format = self.mandarin_config.get('reading_format')
+        self.is_local_reading_enabled = self.mandarin_config.getboolean('is_local_reading_enabled')
+        self.is_dictionary_index_enabled = self.mandarin_config.getboolean('is_dictionary_index_enabled')
+        self.is_chatgpt_enabled = self.openai_config.getboolean('is_chatgpt_enabled')
+        self.similar_words_batch_size = self.openai_config.getint('similar_words_batch_size')
+        self.voice_name = self.azure_config.get('speech_api_voice_name')
+        # An Azure output format name, e.g. audio-24khz-48kbitrate-mono-mp3 or ogg-24khz-16bit-mono-opus, checked here so an unsupported one stops the run before any request
+        self.audio_format = self.azure_config.get('speech_audio_format')
+        self.audio_file_extension = audio_extension(self.audio_format)
+        # Words are only batched into one request when the audio can be split again locally
+        self.speech_batch_size = self.azure_config.getint('speech_batch_size') if is_splittable(self.audio_format) else 1
+
+        self.is_incremental_enabled = self.incremental_config.getboolean('is_incremental_enabled')
+        self.manifest_path = self.incremental_config.get('manifest_path')
+        self.output_mode = self.incremental_config.get('output_mode') if self.is_incremental_enabled else 'full'
+        self.is_checkpoint_enabled = self.checkpoint_config.getboolean('is_checkpoint_enabled')
+        self.is_collection_enabled = self.collection_config.getboolean('is_collection_enabled')
+
+        # Anything which changes a generated note, so changing a setting rebuilds every row
+        self.build_settings = {
+            'is_trad': self.is_trad,
+            'reading_format': self.reading_format,
+            'is_local_reading_enabled': self.is_local_reading_enabled,
+            'is_dictionary_index_enabled': self.is_dictionary_index_enabled,
+            'voice_name': self.voice_name,
+            'audio_format': self.audio_format,
+            'is_chatgpt_enabled': self.is_chatgpt_enabled,
+            'chatgpt_model': chatgpt_model,
+            'similar_words_prompt_version': similar_words_prompt_version,
+            'similar_words_batch_prompt_version': similar_words_batch_prompt_version
+        }
+
+        self.resources = {}
+        self.resources_lock = threading.RLock()
+        # Names of the resources this generator has used, whether its own or shared
+        self.used_resources = set()
+        # Set by the daemon, with resources and lock attributes, to share warm clients and dictionaries between jobs
+        self.shared = shared
+        self.call_policies = {}
+        self.synthesis_futures = {}
+        self.synthesis_lock = threading.Lock()
+        self.audio_stats = {'files': 0, 'bytes': 0, 'pcm_bytes': 0}
+        self.audio_stats_lock = threading.Lock()
+        self.metrics = Metrics()
+        # Words whose similar words failed, so their rows are built again next time rather than kept with a -
+        self.incomplete_words = set()
+
+    def resource(self, name, create):
+        # Clients and dictionaries are created the first time something needs them, once across threads
+        if self.shared is not None and name in shareable_resources:
+            key = ':'.join([name] + [str(getattr(self, setting)) for setting in shareable_resources[name]])
+            resources, lock = self.shared.resources, self.shared.lock
+        else:
+            key, resources, lock = name, self.resources, self.resources_lock
+        self.used_resources.add(name)
+        with lock:
+            if key not in resources:
+                logger.debug('Creating {0}'.format(name))
+                with self.metrics.timer('create.' + name):
+                    resources[key] = create()
+            return resources[key]
+
+    @property
+    def text_translator(self):
+        def create():
+            from azure.ai.translation.text import TextTranslationClient, TranslatorCredential
+            translator_credential = TranslatorCredential(required_option(self.azure_config, 'translator_api_key'), self.azure_config.get('region'))
+            return TextTranslationClient(endpoint=required_option(self.azure_config, 'translator_api_endpoint'), credential=translator_credential)
+        return self.resource('text_translator', create)
+
+    @property
+    def speech_config(self):
+        def create():
+            import azure.cognitiveservices.speech as speechsdk
+            speech_config = speechsdk.SpeechConfig(subscription=required_option(self.azure_config, 'speech_api_key'), region=required_option(self.azure_config, 'region'))
+            speech_config.speech_synthesis_voice_name = self.voice_name
+            speech_config.set_property(speechsdk.PropertyId.SpeechServiceConnection_SynthOutputFormat, self.audio_format)
+            return speech_config
+        return self.resource('speech_config', create)
+
+    @property
+    def synthesis_pool(self):
+        return self.resource('synthesis_pool', lambda: ThreadPoolExecutor(max_workers=self.azure_config.getint('speech_concurrency'), thread_name_prefix='synthesis'))
+
+    @property
+    def idle_synthesizers(self):
+        return self.resource('idle_synthesizers', queue.SimpleQueue)
+
+    @property
+    def rate_limiter(self):
+        def create():
+            import openai
+            openai.organization = self.openai_config.get('organisation')
+            openai.api_key = required_option(self.openai_config, 'api_key')
+            return rate_limiter_from_config(self.openai_config)
+        return self.resource('rate_limiter', create)
+
+    @property
+    def analyser(self):
+        def create():
+            from chinese import ChineseAnalyzer
+            return ChineseAnalyzer()
+        return self.resource('analyser', create)
+
+    @property
+    def dictionary_index(self):
+        return self.resource('dictionary_index', lambda: load_index(self.mandarin_config.get('dictionary_index_path'), self.is_trad))
+
+    @property
+    def dictionary_lookup(self):
+        if self.is_dictionary_index_enabled:
+            return self.dictionary_index.lookup
+        dictionary = self.analyser.dictionary
+        return dictionary.lookup_with_traditional_chinese if self.is_trad else dictionary.lookup_with_simplified_chinese
+
+    def parse(self, mandarin):
+        # The index segments with the dictionary alone, so ChineseAnalyzer and jieba are never loaded
+        with self.metrics.timer('parse'):
+            if self.is_dictionary_index_enabled:
+                return self.dictionary_index.parse(mandarin)
+            return self.analyser.parse(mandarin, traditional=self.is_trad)
+
+    @property
+    def cache(self):
+        return self.resource('cache', lambda: Cache(self.cache_config.get('path'),
+                                                    max_size_mb=self.cache_config.getfloat('max_size_mb'),
+                                                    max_age_days=self.cache_config.getfloat('max_age_days'),
+                                                    enabled=self.cache_config.getboolean('is_cache_enabled')))
+
+    def cached(self, kind, *parts):
+        # Counted here rather than read from the cache at the end, since the daemon's jobs share one cache
+        value = self.cache.get(kind, *parts)
+        if self.cache.enabled:
+            self.metrics.count('cache.hits' if value is not None else 'cache.misses')
+        return value
+
+    @property
+    def media_store(self):
+        return self.resource('media_store', lambda: MediaStore(self.cache_config.get('media_path'),
+                                                               max_size_mb=self.cache_config.getfloat('media_max_size_mb'),
+                                                               max_age_days=self.cache_config.getfloat('media_max_age_days')))
+
+    def is_in_media_store(self, file_name):
+        found = self.media_store.contains(file_name)
+        self.metrics.count('media_store.reused' if found else 'media_store.synthesized')
+        return found
+
+    @property
+    def existing_hanzi(self):
+        def create():
+            paths = [path.strip() for path in self.collection_config.get('path').split(',') if path.strip()]
+            hanzi = read_existing_hanzi(paths, [self.word_model.name, self.sentence_model.name])
+            logger.info('Found {0} words and sentences already in {1}'.format(len(hanzi), ', '.join(paths)))
+            return hanzi
+        return self.resource('existing_hanzi', create)
+
+    @property
+    def manifest(self):
+        return self.resource('manifest', lambda: load_manifest(self.manifest_path) if self.is_incremental_enabled else {})
+
+    @property
+    def journal(self):
+        return self.resource('journal', lambda: Journal(self.checkpoint_config.get('journal_path')))
+
+    @property
+    def word_model(self):
+        return self.resource('word_model', lambda: build_word_model(self.model_config.getint('word_model_id')))
+
+    @property
+    def sentence_model(self):
+        return self.resource('sentence_model', lambda: build_sentence_model(self.model_config.getint('sentence_model_id')))
+
+    def build_word(self, hanzi, definition, audio, reading, similar_words):
+        word_note = genanki.Note(
+                        model=self.word_model,
+                        guid=note_guid(self.word_model, hanzi),
+                        fields=[
+                            str(time.time_ns()),
+                            hanzi,
+                            definition,
+                            audio,
+                            reading,
+                            similar_words
+                        ]
+                    )
+
+        return word_note
+
+    def build_sentence(self, hanzi, definition, audio, reading, guid=None):
+        sentence_note = genanki.Note(
+                        model=self.sentence_model,
+                        guid=guid or note_guid(self.sentence_model, hanzi),
+                        fields=[
+                            str(time.time_ns()),
+                            hanzi,
+                            definition,
+                            audio,
+                            reading
+                        ]
+                    )
+
+        return sentence_note
+
+    def format_reading(self, pinyin, target_format=None):
+        reading = pinyin
+        if (target_format or self.reading_format) == 'zhuyin':
+            try:
+                reading = transcriptions.pinyin_to_zhuyin(pinyin.lower())
+            except Exception as e:
+                logger.error(e)
+                logger.warning("Tried and Failed to transliterate Pinyin to Zhuyin. Falling back to Pinyin.")
+        return reading
+
+    def transliterate_batch(self, hanzi_list, target_format=None):
+        from azure.ai.translation.text.models import InputTextItem
+        target_format = target_format or self.reading_format
+        readings = {}
+        uncached_hanzi = []
+        for hanzi in dict.fromkeys(hanzi_list):
+            cached_reading = self.cached('transliteration', hanzi, self.is_trad, target_format)
+            if cached_reading is not None:
+                logger.debug('Transliteration found in cache: {0}'.format(cached_reading))
+                readings[hanzi] = cached_reading
+            else:
+                uncached_hanzi.append(hanzi)
+        language = 'zh-Hant' if self.is_trad else 'zh-Hans'
+        from_script = 'Hant' if self.is_trad else 'Hans'
+        to_script = 'Latn'
+        for batch in make_batches(uncached_hanzi, transliterate_max_items, transliterate_max_chars):
+            logger.debug('Transliterating batch of {0} Hanzi'.format(len(batch)))
+            text_to_transliterate = [InputTextItem(text = hanzi) for hanzi in batch]
+            self.metrics.count('translator.transliterate.items', len(batch))
+            self.metrics.count('translator.transliterate.characters', sum(len(hanzi) for hanzi in batch))
+            transliteration_response = self.call_policy('translator.transliterate').call(lambda: self.text_translator.transliterate(content=text_to_transliterate,
+                                                                                                                                  language=language,
+                                                                                                                                  from_script=from_script,
+                                                                                                                                  to_script=to_script))
+            for hanzi, transliteration in zip(batch, transliteration_response):
+                reading = self.format_reading(transliteration.text, target_format)
+                logger.debug('Transliteration Successful: {0}'.format(reading))
+                self.cache.set('transliteration', reading, hanzi, self.is_trad, target_format)
+                readings[hanzi] = reading
+        return readings
+
+    def translate_batch(self, hanzi_list):
+        from azure.ai.translation.text.models import InputTextItem
+        definitions = {}
+        uncached_hanzi = []
+        for hanzi in dict.fromkeys(hanzi_list):
+            cached_definition = self.cached('translation', hanzi, self.is_trad)
+            if cached_definition is not None:
+                logger.debug('Translation found in cache: {0}'.format(cached_definition))
+                definitions[hanzi] = cached_definition
+            else:
+                uncached_hanzi.append(hanzi)
+        from_script = 'Hant' if self.is_trad else 'Hans'
+        from_language = 'zh-Hant' if self.is_trad else 'zh_Hans'
+        target_languages = ['en']
+        for batch in make_batches(uncached_hanzi, translate_max_items, translate_max_chars):
+            logger.debug('Translating batch of {0} Hanzi'.format(len(batch)))
+            text_to_translate = [InputTextItem(text = hanzi) for hanzi in batch]
+            self.metrics.count('translator.translate.items', len(batch))
+            self.metrics.count('translator.translate.characters', sum(len(hanzi) for hanzi in batch))
+            translation_response = self.call_policy('translator.translate').call(lambda: self.text_translator.translate(content=text_to_translate,
+                                                                                                                      from_parameter=from_language,
+                                                                                                                      from_script=from_script,
+                                                                                                                      to=target_languages))
+            for hanzi, translation in zip(batch, translation_response):
+                if translation and translation.translations:
+                    definition = translation.translations[0].text
+                    logger.debug('Translation Successful: {0}'.format(definition))
+                    self.cache.set('translation', definition, hanzi, self.is_trad)
+                    definitions[hanzi] = definition
+        return definitions
+
+    def call_policy(self, name):
+        # Deadline, retries and hedging for one kind of Azure call, named after its latency metric
+        with self.resources_lock:
+            if name not in self.call_policies:
+                service = name.split('.')[0]
+                retryable = ()
+                if service == 'translator':
+                    from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+                    retryable = (ServiceRequestError, ServiceResponseError)
+                elif service == 'speech':
+                    retryable = (SynthesisError,)
+                hedge_percentile = self.azure_config.getfloat('hedge_percentile') if self.azure_config.getboolean('is_hedging_enabled') else None
+                self.call_policies[name] = CallPolicy(name, self.metrics, self.azure_config.getfloat(service + '_timeout'),
+                                                      max_retries=self.azure_config.getint('max_retries'),
+                                                      hedge_percentile=hedge_percentile, retryable=retryable)
+            return self.call_policies[name]
+
+    def create_synthesizer(self):
+        import azure.cognitiveservices.speech as speechsdk
+        synthesizer = speechsdk.SpeechSynthesizer(speech_config=self.speech_config, audio_config=None)
+        # Bookmark events arrive on the SDK's own thread, so each synthesizer collects them in its own list
+        bookmarks = []
+        synthesizer.bookmark_reached.connect(bookmarks.append)
+        return synthesizer, bookmarks
+
+    def speak(self, text=None, ssml=None):
+        # Idle synthesizers are reused, and so is their connection, whichever thread the call runs on
         try:
-            reading = transcriptions.pinyin_to_zhuyin(transliteration.text)
+            synthesizer, bookmarks = self.idle_synthesizers.get_nowait()
+        except queue.Empty:
+            synthesizer, bookmarks = self.create_synthesizer()
+        bookmarks.clear()
+        result = (synthesizer.speak_ssml_async(ssml) if ssml is not None else synthesizer.speak_text_async(text)).get()
+        reached = list(bookmarks)
+        self.idle_synthesizers.put((synthesizer, bookmarks))
+        return result, reached
+
+    def speak_completed(self, text=None, ssml=None, description=None):
+        import azure.cognitiveservices.speech as speechsdk
+        result, bookmarks = self.speak(text=text, ssml=ssml)
+        # Azure reports throttling and network failures as a cancelled result rather than raising, so they're retried like any other failed call
+        if result.reason != speechsdk.ResultReason.SynthesizingAudioCompleted:
+            self.metrics.count('speech.failures')
+            raise SynthesisError('Speech synthesis failed for {0}: {1}'.format(description or text, result.cancellation_details.error_details))
+        return result, bookmarks
+
+    def record_audio_stats(self, path, duration):
+        with self.audio_stats_lock:
+            self.audio_stats['files'] += 1
+            self.audio_stats['bytes'] += os.path.getsize(path)
+            self.metrics.count('speech.audio_bytes', os.path.getsize(path))
+            if duration is not None:
+                self.audio_stats['pcm_bytes'] += pcm_size(self.audio_format, duration)
+
+    def audio_report(self):
+        saved_bytes = max(0, self.audio_stats['pcm_bytes'] - self.audio_stats['bytes'])
+        return 'Audio: {0} files synthesized as {1}, {2:.1f} KB written, {3:.1f} KB saved compared to uncompressed PCM'.format(
+            self.audio_stats['files'], self.audio_format, self.audio_stats['bytes'] / 1024, saved_bytes / 1024)
+
+    def synthesize_to_file(self, text, file_name):
+        import azure.cognitiveservices.speech as speechsdk
+        if self.is_in_media_store(file_name):
+            logger.debug('Audio found in media store: {0}'.format(file_name))
+            return self.media_store.path(file_name)
+
+        temporary_path = self.media_store.temporary_path(file_name)
+        self.metrics.count('speech.characters', len(text))
+        result, bookmarks = self.call_policy('speech.synthesize').call(lambda: self.speak_completed(text=text))
+        if self.audio_file_extension == '.wav':
+            stream = speechsdk.AudioDataStream(result)
+            stream.save_to_wav_file(temporary_path)
+        else:
+            # Compressed formats come back ready to use, so the bytes are written as they are
+            pathlib.Path(temporary_path).write_bytes(result.audio_data)
+        path = self.media_store.commit(temporary_path, file_name)
+        self.record_audio_stats(path, result.audio_duration)
+
+        logger.debug('Synthesized successfully, written to file {0}'.format(path))
+        return path
+
+    def submit_synthesis(self, text):
+        # Rows sharing the same utterance share one request and one file
+        file_name = MediaStore.file_name(text, self.voice_name, self.audio_format, self.audio_file_extension)
+        with self.synthesis_lock:
+            if is_retryable(self.synthesis_futures.get(file_name)):
+                self.synthesis_futures[file_name] = self.synthesis_pool.submit(self.synthesize_to_file, text, file_name)
+            return self.synthesis_futures[file_name]
+
+    def synthesize_batch_to_files(self, texts, file_names):
+        # One SSML request for every word, cut into a clip per word at its bookmark
+        self.metrics.count('speech.characters', sum(len(text) for text in texts))
+        self.metrics.count('speech.batched_words', len(texts))
+        ssml = batch_ssml(texts, self.voice_name)
+        result, bookmarks = self.call_policy('speech.synthesize_batch').call(lambda: self.speak_completed(ssml=ssml, description=', '.join(texts)))
+        rate, sample_width, frames = read_pcm(result.audio_data, self.audio_format)
+        offsets = {bookmark.text: bookmark.audio_offset for bookmark in bookmarks}
+        paths = []
+        for text, file_name, clip in zip(texts, file_names, split_clips(frames, rate, sample_width, offsets, len(texts))):
+            if clip is None:
+                logger.warning('No bookmark for {0} in the batch, synthesizing it on its own'.format(text))
+                paths.append(None)
+                continue
+            temporary_path = self.media_store.temporary_path(file_name)
+            write_wav(temporary_path, clip, rate, sample_width)
+            path = self.media_store.commit(temporary_path, file_name)
+            self.record_audio_stats(path, datetime.timedelta(seconds=len(clip) / (rate * sample_width)))
+            paths.append(path)
+        return paths
+
+    def synthesize_batch(self, batch):
+        try:
+            missing = []
+            for text, file_name, future in batch:
+                if self.is_in_media_store(file_name):
+                    future.set_result(self.media_store.path(file_name))
+                else:
+                    missing.append((text, file_name, future))
+            paths = [None] * len(missing)
+            if len(missing) > 1:
+                paths = self.synthesize_batch_to_files([text for text, file_name, future in missing], [file_name for text, file_name, future in missing])
+            for (text, file_name, future), path in zip(missing, paths):
+                future.set_result(path if path is not None else self.synthesize_to_file(text, file_name))
         except Exception as e:
-            logger.error(e)
-            logger.warning("Tried and Failed to transliterate Pinyin to Zhuyin. Falling back to Pinyin.")
-    logger.debug('Transliteration Successful: {0}'.format(reading))
-    return reading
-
-def translate_hanzi(hanzi):
-    logger.debug('Translating Hanzi')
-    from_script = 'Hant' if is_trad else 'Hans'
-    from_language = 'zh-Hant' if is_trad else 'zh_Hans'
-    target_languages = ['en']
-    text_to_translate = [InputTextItem(text = hanzi)]
-    translation_response = text_translator.translate(content=text_to_translate,
-                                                                   from_parameter=from_language,
-                                                                   from_script=from_script,
-                                                                   to=target_languages)
-    translation = translation_response[0] if translation_response else None
-
-    if translation:
-        first_translation = translation.translations[0]
-        if first_translation:
-            definition = first_translation.text
-    logger.debug('Translation Successful: {0}'.format(definition))
-    return definition
-
-def synthesize_text(text):
-    logger.debug('Synthesizing text')
-    # https://github.com/django/django/blob/master/django/utils/text.py
-    normalised_text = unicodedata.normalize('NFKC', text)
-    normalised_text = re.sub(r'[^\w\s-]', '', normalised_text.lower())
-    normalised_text = re.sub(r'[-\s]+', '-', normalised_text).strip('-_')
-    normalised_text += '.wav'
-
-    path = pathlib.Path('tmp', normalised_text)
-
-    speech_synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
-
-    result = speech_synthesizer.speak_text_async(text).get()
-    stream = speechsdk.AudioDataStream(result)
-    stream.save_to_wav_file(str(path))
-
-    media_files.append(str(path))
-
-    logger.debug('Synthesized successfully, written to file {0}'.format(str(path)))
-    return '[sound:' + normalised_text + ']'
-
-def generate_similar_words(word):
-    if is_chatgpt_enabled:
-        logger.debug('Generating Similar Words with ChatGPT')
-        for i in range(0, 3):
+            for text, file_name, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def submit_batch_synthesis(self, texts):
+        # Like submit_synthesis, but the texts which aren't already done or in flight share a single request
+        futures = []
+        batch = []
+        with self.synthesis_lock:
+            for text in texts:
+                file_name = MediaStore.file_name(text, self.voice_name, self.audio_format, self.audio_file_extension)
+                if is_retryable(self.synthesis_futures.get(file_name)):
+                    self.synthesis_futures[file_name] = Future()
+                    batch.append((text, file_name, self.synthesis_futures[file_name]))
+                futures.append(self.synthesis_futures[file_name])
+        if batch:
+            self.synthesis_pool.submit(self.synthesize_batch, batch)
+        return futures
+
+    def chat_completion(self, messages, completion_tokens=500):
+        with self.metrics.timer('chat.completion'):
+            chat_completion = create_chat_completion(self.rate_limiter, completion_tokens=completion_tokens, model=chatgpt_model, messages=messages)
+        self.metrics.count('chat.characters', sum(len(message['content']) for message in messages))
+        usage = getattr(chat_completion, 'usage', None)
+        if usage:
+            self.metrics.count('chat.prompt_tokens', usage.get('prompt_tokens', 0))
+            self.metrics.count('chat.completion_tokens', usage.get('completion_tokens', 0))
+        return chat_completion
+
+    def format_similar_words(self, similar_words):
+        from dragonmapper import hanzi
+        rows = []
+        for row in similar_words:
+            if len(row) == 3:
+                row = [str(column) for column in row]
+                if self.reading_format != 'pinyin' and hanzi.has_chinese(row[0]):
+                    try:
+                        row[1] = transcriptions.pinyin_to_zhuyin(row[1].lower())
+                    except ValueError as e:
+                        logger.exception(e)
+                        logger.warning('Error converting Pinyin to Zhuyin. Will stick with Pinyin for now.')
+                        pass
+                for i in range(0, len(row)):
+                    if ',' in row[i]:
+                        row[i] = '"' + row[i] + '"'
+                rows.append(', '.join(row))
+        return '<br>'.join(rows)
+
+    def parse_similar_words_reply(self, message, words):
+        # Replies are sometimes wrapped in a code block or a sentence, so only look between the outermost braces
+        try:
+            reply = json.loads(message[message.index('{'):message.rindex('}') + 1])
+        except ValueError as e:
+            logger.warning('Could not parse batched Similar Words reply: {0}'.format(e))
+            return {}
+        if not isinstance(reply, dict):
+            return {}
+        similar_words = {}
+        for word in words:
+            rows = reply.get(word)
+            if isinstance(rows, list):
+                formatted = self.format_similar_words(row for row in rows if isinstance(row, list))
+                if formatted != '':
+                    similar_words[word] = formatted
+        return similar_words
+
+    def generate_similar_words_batch(self, words):
+        similar_words = {}
+        if not self.is_chatgpt_enabled:
+            return similar_words
+        import openai
+        uncached_words = []
+        for word in dict.fromkeys(words):
+            cached_message = self.cached('similar_words', word, self.is_trad, self.reading_format, chatgpt_model, similar_words_batch_prompt_version)
+            if cached_message is not None:
+                logger.debug('Similar Words found in cache: {0}'.format(cached_message))
+                similar_words[word] = cached_message
+            else:
+                uncached_words.append(word)
+        if len(uncached_words) > 1:
+            logger.debug('Generating Similar Words with ChatGPT for {0} words'.format(len(uncached_words)))
+            language = 'Traditional Mandarin' if self.is_trad else 'Simplified Mandarin'
             try:
-                language = 'Traditional Mandarin' if is_trad else 'Simplified Mandarin'
-                chat_completion = openai.ChatCompletion.create(model='gpt-3.5-turbo', messages=[
+                chat_completion = self.chat_completion(completion_tokens=150 * len(uncached_words), messages=[
                         {
                             'role': 'system',
                             'content': 'You are a Taiwanese Mandarin Study Assistant generating study material'
                         },
                         {
                             'role': 'user',
-                            'content': 
-    '''Generate 5 words closely related to """{0}""" which are used commonly in Taiwanese Mandarin.
-    You should provide the words in {1}, the readings in Pinyin, and the English Translation, all in CSV format.'''.format(word, language)
+                            'content':
+'''For each of the following words, generate 5 words closely related to it which are used commonly in Taiwanese Mandarin.
+You should provide the words in {1}, the readings in Pinyin, and the English Translation.
+Reply with only a JSON object. Each key is one of the given words exactly as written, and each value is a list of [word, reading, translation] lists.
+Words: {0}'''.format(json.dumps(uncached_words, ensure_ascii=False), language)
                         }
                     ])
+                reply = self.parse_similar_words_reply(chat_completion.choices[0].message.content, uncached_words)
+            except openai.error.OpenAIError as e:
+                logger.exception(e)
+                reply = {}
+            for word, message in reply.items():
+                logger.debug('Similar Words Generated: {0}'.format(message))
+                self.cache.set('similar_words', message, word, self.is_trad, self.reading_format, chatgpt_model, similar_words_batch_prompt_version)
+                similar_words[word] = message
+        # Only the words missing from the reply are retried, one request each
+        for word in uncached_words:
+            if word not in similar_words:
+                similar_words[word] = self.generate_similar_words(word)
+        return similar_words
+
+    def generate_similar_words(self, word):
+        with self.metrics.timer('generate_similar_words'):
+            if self.is_chatgpt_enabled:
+                import openai
+                logger.debug('Generating Similar Words with ChatGPT')
+                cached_message = self.cached('similar_words', word, self.is_trad, self.reading_format, chatgpt_model, similar_words_prompt_version)
+                if cached_message is not None:
+                    logger.debug('Similar Words found in cache: {0}'.format(cached_message))
+                    return cached_message
+                language = 'Traditional Mandarin' if self.is_trad else 'Simplified Mandarin'
+                try:
+                    chat_completion = self.chat_completion(messages=[
+                            {
+                                'role': 'system',
+                                'content': 'You are a Taiwanese Mandarin Study Assistant generating study material'
+                            },
+                            {
+                                'role': 'user',
+                                'content':
+'''Generate 5 words closely related to """{0}""" which are used commonly in Taiwanese Mandarin.
+You should provide the words in {1}, the readings in Pinyin, and the English Translation, all in CSV format.'''.format(word, language)
+                            }
+                        ])
+                except openai.error.OpenAIError as e:
+                    logger.exception(e)
+                    logger.warning('Retried unsuccessfully {0} times, giving up and returning -'.format(self.rate_limiter.max_retries))
+                    self.incomplete_words.add(word)
+                    return '-'
                 message = chat_completion.choices[0].message.content
-                linereader = csv.reader(StringIO(message))
-                rows = []
-                for row in linereader:
-                    if len(row) == 3:
-                        if reading_format != 'pinyin' and hanzi.has_chinese(row[0]):
-                            try:
-                                row[1] = transcriptions.pinyin_to_zhuyin(row[1])
-                            except ValueError as e:
-                                logger.exception(e)
-                                logger.warning('Error converting Pinyin to Zhuyin. Will stick with Pinyin for now.')
-                                pass
-                        for i in range(0, len(row)):
-                            if ',' in row[i]:
-                                row[i] = '"' + row[i] + '"'
-                        rows.append(', '.join(row))
-                message = '<br>'.join(rows)
+                message = self.format_similar_words(csv.reader(StringIO(message)))
                 logger.debug('Similar Words Generated: {0}'.format(message))
+                self.cache.set('similar_words', message, word, self.is_trad, self.reading_format, chatgpt_model, similar_words_prompt_version)
                 return message
-            except openai.error.APIError as e:
-                logger.exception(e)
-                logger.warning('OpenAI exception, info written to errlog, retrying {0}th time'.format(i))
-            except openai.error.RateLimitError as e:
-                logger.exception(e)
-                logger.warning('Reached OpenAI rate limit of 3 per minute. Waiting one minute before trying again.')
-                time.sleep(60)
-    logger.warning('Retried unsuccessfully three times, giving up and returning -')
-    return '-'
-
-def find_all(source_string, search_char):
-    return [i for i, character in enumerate(source_string) if character == search_char]
+            return '-'
 
-with open('input.csv', encoding='utf-8') as input_file:
-    linereader = csv.reader(input_file, skipinitialspace=True)
-    for row in linereader:
-        if len(row) > 0:
-            mandarin = row[0]
-            analysis = analyser.parse(mandarin, traditional=is_trad)
-            if len(analysis.tokens()) == 1: #Single Word
-                logger.info('Found Word: {0}'.format(mandarin))
-                reading = ''
-                word_info = analysis[mandarin][0]
-                definition = ''
-                if len(row) == 2:
-                    definition = row[1]
-                elif word_info.definitions is not None:
-                    definition = ', '.join(word_info.definitions)
-                else:
-                    definition = translate_hanzi(mandarin)
-                    reading = transliterate_hanzi(mandarin)
-                audio = synthesize_text(mandarin)
-                if reading == '':
-                    reading = analysis.pinyin()
-                    if reading_format == 'zhuyin':
-                        try:
-                            reading = transcriptions.pinyin_to_zhuyin(analysis.pinyin())
-                        except Exception as e:
-                            logger.error(e)
-                            logger.warning("transliteration.text")
-                similar_words = generate_similar_words(mandarin)
-                word_note = build_word(mandarin, definition, audio, reading, similar_words)
-                deck.add_note(word_note)
-            else: #Sentence
-                logger.info('Found Sentence: {0}'.format(mandarin))
-                star_locations = []
-                starred_hanzi = []
-                if '*' in mandarin:
-                    star_locations = find_all(mandarin, '*')
-                    for i in range(0, len(star_locations), 2):
-                        if len(star_locations) >= i+2:
-                            starred_hanzi.append(mandarin[star_locations[i]+1:star_locations[i+1]])
-                    mandarin = mandarin.replace('*', '')
-                    logger.debug('Found and extracted starred words: {0}'.format(starred_hanzi))
-                definition = ''
-                if len(row) == 2:
-                    definition = row[1]
+    def classify_row(self, row):
+        mandarin = row[0]
+        content_hash = row_hash(row, self.build_settings)
+        if self.is_incremental_enabled:
+            record = self.manifest.get(mandarin)
+            if record is not None and record['hash'] == content_hash:
+                logger.info('Unchanged, skipping: {0}'.format(mandarin))
+                return {'hanzi': mandarin, 'row_key': mandarin, 'is_built': True, 'is_resumed': False, 'record': record}
+        if self.is_checkpoint_enabled:
+            record = self.journal.get(mandarin, content_hash)
+            if record is not None and all(os.path.exists(path) for path in record['media']):
+                logger.info('Finished before the run was interrupted, resuming: {0}'.format(mandarin))
+                return {'hanzi': mandarin, 'row_key': mandarin, 'is_built': True, 'is_resumed': True, 'record': record}
+        analysis = self.parse(mandarin)
+        entry = {
+            'hanzi': mandarin,
+            'row_key': mandarin,
+            'hash': content_hash,
+            'is_built': False,
+            'analysis': analysis,
+            'definition': row[1] if len(row) >= 2 and row[1] != '' else None,
+            # An optional third column, e.g. the reading ChatGPT gave a generated sentence, saves transliterating it again
+            'reading': self.format_reading(row[2]) if len(row) >= 3 and row[2] != '' else None,
+            'is_failed': False,
+            'starred_hanzi': [],
+            'needs_transliteration': False
+        }
+        if len(analysis.tokens()) == 1: #Single Word
+            logger.info('Found Word: {0}'.format(mandarin))
+            entry['is_word'] = True
+            word_info = analysis[mandarin][0]
+            if entry['definition'] is None:
+                if word_info.definitions is not None:
+                    entry['definition'] = ', '.join(word_info.definitions)
                 else:
-                    definition = translate_hanzi(mandarin)
-                audio = synthesize_text(mandarin)
-                reading = transliterate_hanzi(mandarin)
-                if len(starred_hanzi) != 0:
-                    starred_reading = map(lambda selected_character: hanzi.to_pinyin(selected_character, all_readings=True)[1:-1].split('/') if reading_format == 'pinyin' else hanzi.to_zhuyin(selected_character, all_readings=True)[1:-1].split('/'), starred_hanzi)
-                    for selected_character in starred_hanzi:
-                        i = mandarin.index(selected_character)
-                        output_string = mandarin[:i] + '<span class=starred>' + selected_character + '</span>' + mandarin[i + len(selected_character):]
-                        mandarin = output_string
-                    for selected_character in starred_reading:
-                        i = -1
-                        correct_reading = 0
-                        for one_reading in selected_character:
-                            try:
-                                i = reading.index(one_reading)
-                                break
-                            except ValueError:
-                                logger.debug('Reading wasnt found, checking other readings')
-                                correct_reading += 1
-                        if i >= 0:
-                            output_string = reading[:i] + '<span class=starred>' + selected_character[correct_reading] + '</span>' + reading[i + len(selected_character[correct_reading]):]
-                            reading = output_string
-                sentence_note = build_sentence(mandarin, definition, audio, reading)
-                deck.add_note(sentence_note)
-            logger.info('')
-
-output_package = genanki.Package(deck)
-output_package.media_files = media_files
-output_package.write_to_file('output.apkg')
-
-shutil.rmtree('tmp')
\ No newline at end of file
+                    entry['needs_transliteration'] = entry['reading'] is None
+        else: #Sentence
+            logger.info('Found Sentence: {0}'.format(mandarin))
+            entry['is_word'] = False
+            if '*' in mandarin:
+                star_locations = find_all(mandarin, '*')
+                for i in range(0, len(star_locations), 2):
+                    if len(star_locations) >= i+2:
+                        entry['starred_hanzi'].append(mandarin[star_locations[i]+1:star_locations[i+1]])
+                entry['hanzi'] = mandarin.replace('*', '')
+                entry['analysis'] = self.parse(entry['hanzi'])
+                logger.debug('Found and extracted starred words: {0}'.format(entry['starred_hanzi']))
+            entry['needs_transliteration'] = entry['reading'] is None
+        return entry
+
+    def enrich_entries(self, entries):
+        # Gather every missing definition and reading so they can be sent in as few requests as possible
+        definitions = self.translate_batch([entry['hanzi'] for entry in entries if entry['definition'] is None])
+        if self.is_local_reading_enabled:
+            from reading import local_syllables, unresolved_tokens, render_reading
+            local_readings = {id(entry): local_syllables(entry['analysis'], self.dictionary_lookup) for entry in entries if entry['needs_transliteration']}
+            # Only the tokens the dictionaries can't read are sent to Azure
+            unresolved = [token for token_readings in local_readings.values() for token in unresolved_tokens(token_readings)]
+            # Without a Translator key they're left in Hanzi rather than failing the row
+            fallback_readings = self.transliterate_batch(unresolved, target_format='pinyin') if self.azure_config.get('translator_api_key') else {}
+            readings = {}
+        else:
+            readings = self.transliterate_batch([entry['hanzi'] for entry in entries if entry['needs_transliteration']])
+        for entry in entries:
+            if entry['definition'] is None:
+                entry['definition'] = definitions.get(entry['hanzi'], '')
+            if entry['needs_transliteration'] and self.is_local_reading_enabled:
+                entry['reading'] = self.format_reading(render_reading(local_readings[id(entry)], fallback_readings))
+            elif entry['needs_transliteration']:
+                entry['reading'] = readings.get(entry['hanzi'], '')
+        return entries
+
+    async def synthesize_entry(self, entry):
+        entry['audio_path'] = await asyncio.wrap_future(self.submit_synthesis(entry['hanzi']))
+        entry['audio'] = sound_tag(entry['audio_path'])
+        return entry
+
+    async def synthesize_entries(self, entries):
+        words = [entry for entry in entries if entry['is_word']]
+        futures = self.submit_batch_synthesis([entry['hanzi'] for entry in words])
+        futures += [self.submit_synthesis(entry['hanzi']) for entry in entries if not entry['is_word']]
+        paths = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        for entry, path in zip(words + [entry for entry in entries if not entry['is_word']], paths):
+            entry['audio_path'] = path
+            entry['audio'] = sound_tag(path)
+        return entries
+
+    def generate_similar_words_entries(self, entries):
+        if self.similar_words_batch_size > 1:
+            similar_words = self.generate_similar_words_batch([entry['hanzi'] for entry in entries if entry['is_word']])
+        else:
+            similar_words = {entry['hanzi']: self.generate_similar_words(entry['hanzi']) for entry in entries if entry['is_word']}
+        for entry in entries:
+            entry['similar_words'] = similar_words.get(entry['hanzi'], '-') if entry['is_word'] else None
+        return entries
+
+    def build_word_entry(self, entry):
+        mandarin = entry['hanzi']
+        analysis = entry['analysis']
+        reading = entry['reading'] or ''
+        audio = entry['audio']
+        if reading == '':
+            reading = analysis.pinyin()
+            if self.reading_format == 'zhuyin':
+                try:
+                    reading = transcriptions.pinyin_to_zhuyin(analysis.pinyin().lower())
+                except Exception as e:
+                    logger.error(e)
+                    logger.warning("transliteration.text")
+        return self.build_word(mandarin, entry['definition'], audio, reading, entry['similar_words'])
+
+    def build_sentence_entry(self, entry):
+        from dragonmapper import hanzi
+        mandarin = entry['hanzi']
+        starred_hanzi = entry['starred_hanzi']
+        audio = entry['audio']
+        reading = entry['reading']
+        if len(starred_hanzi) != 0:
+            starred_reading = map(lambda selected_character: hanzi.to_pinyin(selected_character, all_readings=True)[1:-1].split('/') if self.reading_format == 'pinyin' else hanzi.to_zhuyin(selected_character, all_readings=True)[1:-1].split('/'), starred_hanzi)
+            for selected_character in starred_hanzi:
+                i = mandarin.index(selected_character)
+                output_string = mandarin[:i] + '<span class=starred>' + selected_character + '</span>' + mandarin[i + len(selected_character):]
+                mandarin = output_string
+            for selected_character in starred_reading:
+                i = -1
+                correct_reading = 0
+                for one_reading in selected_character:
+                    try:
+                        i = reading.index(one_reading)
+                        break
+                    except ValueError:
+                        logger.debug('Reading wasnt found, checking other readings')
+                        correct_reading += 1
+                if i >= 0:
+                    output_string = reading[:i] + '<span class=starred>' + selected_character[correct_reading] + '</span>' + reading[i + len(selected_character[correct_reading]):]
+                    reading = output_string
+        return self.build_sentence(mandarin, entry['definition'], audio, reading, guid=note_guid(self.sentence_model, entry['hanzi']))
+
+    def is_complete(self, entry):
+        return entry['audio_path'] is not None and entry['hanzi'] not in self.incomplete_words
+
+    def assemble_entry(self, entry):
+        # Returns the note and its media, or None for an unchanged row left out of a delta package
+        if entry['is_built']:
+            record = entry['record']
+            if entry['is_resumed']:
+                # Built by the interrupted run, so it is as new as any row built now
+                self.manifest[entry['row_key']] = record
+            elif self.output_mode != 'full':
+                return None, []
+            return self.note_from_record(record), [path for path in record['media'] if os.path.exists(path)]
+        if entry['is_failed']:
+            # Left out of the package and the journal, so the next run tries it again
+            logger.error('Gave up on {0} after retrying, leaving it out'.format(entry['hanzi']))
+            return None, []
+        logger.info('Building: {0}'.format(entry['hanzi']))
+        if entry['is_word']:
+            note = self.build_word_entry(entry)
+        else:
+            note = self.build_sentence_entry(entry)
+        media = [entry['audio_path']] if entry['audio_path'] is not None else []
+        record = {
+            'hash': entry['hash'],
+            'model': 'word' if entry['is_word'] else 'sentence',
+            'guid': note.guid,
+            'fields': note.fields,
+            'media': media
+        }
+        # Rows missing their similar words are kept out of the manifest and journal, so the next run builds them again
+        if self.is_complete(entry):
+            self.manifest[entry['row_key']] = record
+            if self.is_checkpoint_enabled:
+                self.journal.append(entry['row_key'], record)
+        return note, media
+
+    def fail_entry(self, entry):
+        entry['is_failed'] = True
+        return entry
+
+    def stages(self):
+        # Rows a service keeps failing on are retried later in the run, then left out rather than stopping it
+        retries = {'attempts': self.pipeline_config.getint('retry_attempts'), 'retry_delay': self.pipeline_config.getfloat('retry_delay'), 'fallback': self.fail_entry}
+        return [
+            Stage('parse', self.classify_row, concurrency=self.pipeline_config.getint('parse_concurrency')),
+            Stage('text', self.enrich_entries, concurrency=self.pipeline_config.getint('text_concurrency'), batch_size=self.pipeline_config.getint('text_batch_size'), skip=is_skipped, **retries),
+            Stage('audio', self.synthesize_entry, concurrency=self.azure_config.getint('speech_concurrency'), skip=is_skipped, **retries) if self.speech_batch_size <= 1 else
+            Stage('audio', self.synthesize_entries, concurrency=self.azure_config.getint('speech_concurrency'), batch_size=self.speech_batch_size, batch_wait=self.pipeline_config.getfloat('speech_batch_wait'), skip=is_skipped, **retries),
+            Stage('similar_words', self.generate_similar_words_entries, concurrency=self.pipeline_config.getint('similar_words_concurrency'), batch_size=self.similar_words_batch_size, batch_wait=self.pipeline_config.getfloat('similar_words_batch_wait') if self.is_chatgpt_enabled else 0, skip=is_skipped, **retries)
+        ]
+
+    def note_from_record(self, record):
+        model = self.word_model if record['model'] == 'word' else self.sentence_model
+        return genanki.Note(model=model, guid=record['guid'], fields=record['fields'])
+
+    def new_deck(self):
+        deck = genanki.Deck(
+            self.model_config.getint('deck_id'),
+            'Generated Mandarin Flashcards'
+        )
+        deck.add_model(self.word_model)
+        deck.add_model(self.sentence_model)
+        return deck
+
+    def run_stages(self, rows, sink, stages=None):
+        stages = stages or self.stages()
+        asyncio.run(run_pipeline(rows, stages, sink, queue_size=self.pipeline_config.getint('queue_size')))
+        for stage in stages:
+            self.metrics.count('stage.{0}.busy_seconds'.format(stage.name), stage.busy_time)
+            self.metrics.count('stage.{0}.items'.format(stage.name), stage.processed)
+            self.metrics.count('stage.{0}.deferred'.format(stage.name), stage.deferred)
+            self.metrics.count('stage.{0}.failed'.format(stage.name), stage.failed)
+
+    def skip_existing(self, rows):
+        # Rows already in the Anki collection are dropped before anything is sent to a service
+        for row in rows:
+            if self.is_collection_enabled and row[0].replace('*', '') in self.existing_hanzi:
+                logger.info('Already in the Anki collection, skipping: {0}'.format(row[0]))
+                self.metrics.count('collection.skipped')
+                continue
+            yield row
+
+    def needs_translator(self, row):
+        # A row with its definition, and its reading or local readings to make one, is never sent to the Translator
+        has_definition = len(row) >= 2 and row[1] != ''
+        has_reading = len(row) >= 3 and row[2] != ''
+        return not has_definition or not (has_reading or self.is_local_reading_enabled)
+
+    def check_credentials(self, rows):
+        # Fails before the run starts rather than on every row, and only for the keys of services the rows will use
+        if not rows:
+            return
+        for option in ('speech_api_key', 'region'):
+            required_option(self.azure_config, option)
+        if any(self.needs_translator(row) for row in rows):
+            for option in ('translator_api_key', 'translator_api_endpoint'):
+                required_option(self.azure_config, option)
+        if self.is_chatgpt_enabled:
+            required_option(self.openai_config, 'api_key')
+
+    def build_package(self, rows, stages=None):
+        rows = list(self.skip_existing(rows))
+        self.check_credentials(rows)
+        if self.pipeline_config.getint('processes') > 1:
+            return self.build_package_sharded(rows, self.pipeline_config.getint('processes'))
+        deck = self.new_deck()
+        media_files = []
+
+        def add_entry(entry):
+            # Runs in input order, so the deck and media_files come out the same however the stages interleave
+            note, media = self.assemble_entry(entry)
+            if note is not None:
+                deck.add_note(note)
+            for path in media:
+                if path not in media_files:
+                    media_files.append(path)
+
+        self.run_stages(rows, add_entry, stages)
+
+        output_package = genanki.Package(deck)
+        output_package.media_files = media_files
+        return output_package
+
+    def build_records(self, rows):
+        # Notes as plain records rather than genanki objects, so a worker process can send them back
+        records = []
+
+        def add_entry(entry):
+            note, media = self.assemble_entry(entry)
+            if note is not None:
+                records.append({'model': 'word' if note.model is self.word_model else 'sentence', 'guid': note.guid, 'fields': note.fields, 'media': media})
+
+        self.run_stages(rows, add_entry)
+        manifest_records = {row[0]: self.manifest[row[0]] for row in rows if row[0] in self.manifest}
+        return records, manifest_records
+
+    def shard_config(self, processes):
+        settings = {section: dict(self.config[section]) for section in self.config.sections()}
+        # The quotas are shared by the whole account, so each process gets its share of them
+        for section, option in [('openai', 'requests_per_minute'), ('openai', 'tokens_per_minute'), ('azure', 'speech_concurrency')]:
+            settings[section][option] = str(max(1, self.config[section].getint(option) // processes))
+        settings['pipeline']['processes'] = '1'
+        return settings
+
+    def build_package_sharded(self, rows, processes):
+        rows = list(rows)
+        shard_size = max(1, math.ceil(len(rows) / processes))
+        shards = [rows[i:i + shard_size] for i in range(0, len(rows), shard_size)]
+        logger.info('Building {0} rows in {1} processes'.format(len(rows), len(shards)))
+        settings = self.shard_config(processes)
+        if self.is_dictionary_index_enabled:
+            # Built here if it's missing, so the workers only have to open it
+            self.dictionary_index
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            # map returns the shards in input order, whichever process finishes first
+            results = list(pool.map(build_shard, [settings] * len(shards), shards))
+
+        deck = self.new_deck()
+        media_files = []
+        seen_media = set()
+        for records, manifest_records, metrics_state in results:
+            self.manifest.update(manifest_records)
+            self.metrics.merge(metrics_state)
+            for record in records:
+                deck.add_note(self.note_from_record(record))
+                # Rows in different shards can share the same audio, which only needs adding once
+                for path in record['media']:
+                    if path not in seen_media:
+                        seen_media.add(path)
+                        media_files.append(path)
+
+        output_package = genanki.Package(deck)
+        output_package.media_files = media_files
+        return output_package
+
+    def write_package(self, output_package, output_path='output.apkg'):
+        with self.metrics.timer('package.write'):
+            output_package.write_to_file(output_path)
+        self.metrics.count('package.bytes', os.path.getsize(output_path))
+
+        if self.is_incremental_enabled:
+            save_manifest(self.manifest_path, self.manifest)
+        if self.is_checkpoint_enabled:
+            self.journal.remove()
+        # The daemon's jobs share the media store, so it evicts once it stops instead
+        if self.shared is None:
+            self.evict_media()
+
+    def evict_media(self):
+        # Audio of rows in the manifest or an unfinished journal is kept, since those rows won't be synthesized again
+        records = list(load_manifest(self.manifest_path).values()) + list(Journal(self.checkpoint_config.get('journal_path')).records.values())
+        evicted = self.media_store.evict(keep=[path for record in records for path in record['media']])
+        self.metrics.count('media_store.evicted', evicted)
+        if evicted:
+            logger.info('Evicted {0} unused audio files from {1}'.format(evicted, self.media_store.directory))
+
+    def build_deck(self, rows, output_path='output.apkg'):
+        output_package = self.build_package(rows)
+        self.write_package(output_package, output_path)
+        return output_package.decks[0]
+
+    def dry_run(self, rows):
+        # Classifies every row with the local dictionary only, without calling any service or writing a package
+        counts = {'words': 0, 'sentences': 0, 'unchanged': 0, 'translations': 0, 'readings': 0}
+        rows = list(rows)
+        new_rows = list(self.skip_existing(rows))
+        counts['existing'] = len(rows) - len(new_rows)
+        for row in new_rows:
+            entry = self.classify_row(row)
+            if entry['is_built']:
+                counts['unchanged'] += 1
+                continue
+            counts['words' if entry['is_word'] else 'sentences'] += 1
+            if entry['definition'] is None:
+                counts['translations'] += 1
+            if entry['needs_transliteration']:
+                counts['readings'] += 1
+        logger.info('Dry run: {words} words, {sentences} sentences, {existing} already in Anki, {unchanged} unchanged, {translations} need translating, {readings} need readings'.format(**counts))
+        return counts
+
+    def close(self, report=True):
+        # Resources shared with the daemon's other jobs stay open, but this job's audio is still reported
+        if 'synthesis_pool' in self.resources:
+            self.synthesis_pool.shutdown()
+        if 'synthesis_pool' in self.used_resources:
+            logger.info(self.audio_report())
+        if 'dictionary_index' in self.resources:
+            self.dictionary_index.close()
+        if 'journal' in self.resources:
+            self.journal.close()
+        if 'cache' in self.resources:
+            self.cache.close()
+            logger.info(self.cache.report())
+        if 'media_store' in self.resources:
+            logger.info(self.media_store.report())
+        self.collect_metrics()
+        if report:
+            self.report_metrics()
+
+    def collect_metrics(self):
+        if 'rate_limiter' in self.resources:
+            self.metrics.count('chat.retries', self.rate_limiter.retries)
+            self.metrics.count('chat.rate_limited', self.rate_limiter.rate_limited)
+            self.metrics.count('chat.rate_limit_wait_seconds', self.rate_limiter.waited)
+
+    def report_metrics(self):
+        logger.info('Run metrics:\n' + self.metrics.table())
+        if self.metrics_config.getboolean('is_metrics_enabled'):
+            self.metrics.write(self.metrics_config.get('path'))
+
+def build_shard(settings, rows):
+    # Runs in a worker process, which builds its own clients and writes into the same media store and cache
+    config = configparser.ConfigParser()
+    config.read_dict(settings)
+    generator = CardGenerator(config)
+    try:
+        records, manifest_records = generator.build_records(rows)
+    finally:
+        generator.close(report=False)
+    return records, manifest_records, generator.metrics.state()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate Anki flashcards from a list of Mandarin words and sentences.')
+    parser.add_argument('--config', default='config.ini', help='Config file, missing options are filled in and written back')
+    parser.add_argument('--input', default='input.csv', help='CSV of Hanzi with optional definitions and readings')
+    parser.add_argument('--output', default='output.apkg', help='Anki package to write')
+    parser.add_argument('--dry-run', action='store_true', help='Only check which rows are words or sentences and what they still need')
+    parser.add_argument('--processes', type=int, help='Split the input between this many processes, overriding the processes option')
+    parser.add_argument('--sentences', action='store_true', help='Also generate example sentences for the words with ChatGPT, as gensents.py does, and add them to the package')
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    # Batch jobs have no terminal to answer the prompts, and a dry run never calls a service
+    config = load_config(args.config, interactive=sys.stdin.isatty() and not args.dry_run)
+    if args.processes is not None:
+        config['pipeline']['processes'] = str(args.processes)
+    generator = CardGenerator(config)
+    try:
+        if args.dry_run:
+            generator.dry_run(read_input_rows(args.input))
+        elif args.sentences:
+            import gensents
+            rows = list(read_input_rows(args.input))
+            sentence_generator = gensents.SentenceGenerator(gensents.load_config(args.config, interactive=sys.stdin.isatty()))
+            generator.build_deck(rows + list(sentence_generator.card_rows(rows)), args.output)
+        else:
+            generator.build_deck(read_input_rows(args.input), args.output)
+    finally:
+        generator.close()
+
+if __name__ == '__main__':
+    main()
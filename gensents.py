@@ -1,99 +1,218 @@
+import sys
 import configparser
-import random
-from chinese import ChineseAnalyzer
-from dragonmapper import transcriptions, hanzi
+import argparse
+from dragonmapper import transcriptions
 import csv
-import openai
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from ratelimit import create_chat_completion, rate_limiter_from_config
+from dictindex import load_index
+from gencards import read_input_rows, required_option
+
+def load_config(path='config.ini', interactive=True):
+    config = configparser.ConfigParser()
 
-def generate_id():
-    return str(random.randrange(1 << 30, 1 << 31))
-
-config = configparser.ConfigParser()
-
-config.read('config.ini')
-
-if not config.has_section('mandarin'):
-    config.add_section('mandarin')
-
-mandarin_config = config['mandarin']
-
-if not config.has_option('mandarin', 'is_trad'):
-    config['mandarin']['is_trad'] = 'false'
-
-if not config.has_option('mandarin', 'reading_format'):
-    config['mandarin']['reading_format'] = 'pinyin'
-
-if not config.has_section('openai'):
-    config.add_section('openai')
-
-openai_config = config['openai']
-
-if not config.has_option('openai', 'api_key'):
-    print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
-    config['openai']['api_key'] = input('OpenAi API Key: ')
-
-if not config.has_option('openai', 'organisation'):
-    print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
-    config['openai']['organisation'] = input('Organisation ID: ')
-
-with open('config.ini', 'w') as configfile:
-    config.write(configfile)
-
-openai.organization = openai_config.get('organisation')
-openai.api_key = openai_config.get('api_key')
-
-analyser = ChineseAnalyzer()
-
-reading_format = mandarin_config.get('reading_format')
-is_trad = mandarin_config.get('is_trad')
-
-def generate_sentences(words):
-    for i in range(0, 3):
-        try:
-            language = 'Traditional Mandarin' if is_trad else 'Simplified Mandarin'
-            chat_completion = openai.ChatCompletion.create(model='gpt-3.5-turbo', messages=[
-                    {
-                        'role': 'system',
-                        'content': 'You are a Taiwanese Mandarin Study Assistant generating example Mandarin sentences.'
-                    },
-                    {
-                        'role': 'user',
-                        'content': 
-'''Create two example sentences for each of the following Mandarin words.
-CSV format with the following columns: {0} Sentence, Pinyin Transliteration, English Translation. Use the pipe(|) character as a delimiter. Don't 
-Example row: 她給我很大的安慰.|tā gěi wǒ hěn dà de ān wèi.|She gave me great comfort.
-Words: """{1}"""'''.format(language, words)
-                    }
-                ])
-            message = chat_completion.choices[0].message.content
-            linereader = csv.reader(StringIO(message), delimiter='|')
-            rows = []
-            for row in linereader:
-                if len(row) == 3:
-                    if reading_format != 'pinyin' and hanzi.has_chinese(row[0]):
-                        row[1] = transcriptions.pinyin_to_zhuyin(row[1].lower())
-                    for i in range(0, len(row)):
-                        if ',' in row[i]:
-                            row[i] = '"' + row[i] + '"'
-                    rows.append(','.join(row))
-            message = '\n'.join(rows)
-            return message
-        except openai.error.APIError:
-            print('OpenAI exception, retrying {0}th time'.format(i))
-    return '-'
-
-with open('input.csv', encoding='utf-8') as input_file:
-    linereader = csv.reader(input_file, skipinitialspace=True)
-    words = []
-    for row in linereader:
-        if len(row) > 0:
+    config.read(path)
+
+    if not config.has_section('mandarin'):
+        config.add_section('mandarin')
+
+    if not config.has_option('mandarin', 'is_trad'):
+        config['mandarin']['is_trad'] = 'false'
+
+    if not config.has_option('mandarin', 'reading_format'):
+        config['mandarin']['reading_format'] = 'pinyin'
+
+    if not config.has_option('mandarin', 'is_dictionary_index_enabled'):
+        config['mandarin']['is_dictionary_index_enabled'] = 'true'
+
+    if not config.has_option('mandarin', 'dictionary_index_path'):
+        config['mandarin']['dictionary_index_path'] = 'dictionary'
+
+    if not config.has_section('openai'):
+        config.add_section('openai')
+
+    if interactive:
+        if not config.has_option('openai', 'api_key'):
+            print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
+            config['openai']['api_key'] = input('OpenAi API Key: ')
+
+        if not config.has_option('openai', 'organisation'):
+            print('Missing OpenAi Config. See here: https://platform.openai.com/docs/api-reference/authentication')
+            config['openai']['organisation'] = input('Organisation ID: ')
+
+    if not config.has_option('openai', 'requests_per_minute'):
+        config['openai']['requests_per_minute'] = '3'
+
+    if not config.has_option('openai', 'tokens_per_minute'):
+        config['openai']['tokens_per_minute'] = '40000'
+
+    if not config.has_option('openai', 'max_retries'):
+        config['openai']['max_retries'] = '5'
+
+    if not config.has_option('openai', 'request_timeout'):
+        config['openai']['request_timeout'] = '120'
+
+    if not config.has_option('openai', 'sentences_batch_size'):
+        config['openai']['sentences_batch_size'] = '20'
+
+    if not config.has_option('openai', 'sentences_concurrency'):
+        config['openai']['sentences_concurrency'] = '4'
+
+    if not config.has_option('openai', 'sentences_attempts'):
+        config['openai']['sentences_attempts'] = '3'
+
+    with open(path, 'w') as configfile:
+        config.write(configfile)
+
+    return config
+
+def format_row(row):
+    return ','.join('"' + field + '"' if ',' in field else field for field in row)
+
+class SentenceGenerator:
+    def __init__(self, config):
+        self.config = config
+        self.mandarin_config = config['mandarin']
+        self.openai_config = config['openai']
+        self.reading_format = self.mandarin_config.get('reading_format')
+        self.is_trad = self.mandarin_config.getboolean('is_trad')
+        self.is_dictionary_index_enabled = self.mandarin_config.getboolean('is_dictionary_index_enabled')
+        self.batch_size = max(1, self.openai_config.getint('sentences_batch_size'))
+        self.concurrency = max(1, self.openai_config.getint('sentences_concurrency'))
+        self.attempts = max(1, self.openai_config.getint('sentences_attempts'))
+        self.resources = {}
+        self.resources_lock = threading.RLock()
+
+    def resource(self, name, create):
+        with self.resources_lock:
+            if name not in self.resources:
+                self.resources[name] = create()
+            return self.resources[name]
+
+    @property
+    def rate_limiter(self):
+        def create():
+            import openai
+            openai.organization = self.openai_config.get('organisation')
+            openai.api_key = required_option(self.openai_config, 'api_key')
+            return rate_limiter_from_config(self.openai_config)
+        return self.resource('rate_limiter', create)
+
+    @property
+    def analyser(self):
+        def create():
+            from chinese import ChineseAnalyzer
+            return ChineseAnalyzer()
+        return self.resource('analyser', create)
+
+    @property
+    def dictionary_index(self):
+        return self.resource('dictionary_index', lambda: load_index(self.mandarin_config.get('dictionary_index_path'), self.is_trad))
+
+    def parse(self, mandarin):
+        if self.is_dictionary_index_enabled:
+            return self.dictionary_index.parse(mandarin)
+        return self.analyser.parse(mandarin, traditional=self.is_trad)
+
+    def find_words(self, rows):
+        words = []
+        for row in rows:
             mandarin = row[0]
-            analysis = analyser.parse(mandarin, traditional=is_trad)
+            analysis = self.parse(mandarin)
             if len(analysis.tokens()) == 1: #Single Word
                 words.append(mandarin)
-
-    generated_sentences = generate_sentences(', '.join(words))
-
-    with open('generated_sentences.csv', 'w', encoding='utf-8') as output_file:
-        output_file.write(generated_sentences)
\ No newline at end of file
+        return words
+
+    def request_sentences(self, words):
+        from dragonmapper import hanzi
+        language = 'Traditional Mandarin' if self.is_trad else 'Simplified Mandarin'
+        chat_completion = create_chat_completion(self.rate_limiter, completion_tokens=100 * len(words), model='gpt-3.5-turbo', messages=[
+                {
+                    'role': 'system',
+                    'content': 'You are a Taiwanese Mandarin Study Assistant generating example Mandarin sentences.'
+                },
+                {
+                    'role': 'user',
+                    'content':
+'''Create two example sentences for each of the following Mandarin words.
+CSV format with the following columns: {0} Sentence, Pinyin Transliteration, English Translation. Use the pipe(|) character as a delimiter. Don't
+Example row: 她給我很大的安慰.|tā gěi wǒ hěn dà de ān wèi.|She gave me great comfort.
+Words: """{1}"""'''.format(language, ', '.join(words))
+                }
+            ])
+        message = chat_completion.choices[0].message.content
+        linereader = csv.reader(StringIO(message), delimiter='|')
+        rows = []
+        for row in linereader:
+            if len(row) == 3:
+                if self.reading_format != 'pinyin' and hanzi.has_chinese(row[0]):
+                    try:
+                        row[1] = transcriptions.pinyin_to_zhuyin(row[1].lower())
+                    except ValueError as e:
+                        # Readings with Latin words in them, e.g. wǒ xǐhuān iPhone., can't be converted
+                        print('Error converting Pinyin to Zhuyin for {0}, keeping Pinyin: {1}'.format(row[0], e))
+                rows.append(row)
+        return rows
+
+    def generate_chunk(self, words):
+        import openai
+        # Each chunk is retried on its own, so one bad reply doesn't cost the sentences already generated for the others
+        for attempt in range(1, self.attempts + 1):
+            try:
+                rows = self.request_sentences(words)
+            except openai.error.OpenAIError as e:
+                print('OpenAI exception for {0} (attempt {1}/{2}): {3}'.format(', '.join(words), attempt, self.attempts, e))
+                continue
+            if rows:
+                return rows
+            print('No sentences in the reply for {0} (attempt {1}/{2})'.format(', '.join(words), attempt, self.attempts))
+        print('Giving up on: {0}'.format(', '.join(words)))
+        return []
+
+    def generate_sentences(self, words):
+        # Yields the rows for each chunk of words in input order, as soon as that chunk and the ones before it are done
+        chunks = [words[i:i + self.batch_size] for i in range(0, len(words), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.generate_chunk, chunk) for chunk in chunks]
+            for i, future in enumerate(futures):
+                rows = future.result()
+                print('Chunk {0}/{1}: {2} sentences for {3} words'.format(i + 1, len(chunks), len(rows), len(chunks[i])))
+                yield rows
+
+    def write_sentences(self, rows, output_path='generated_sentences.csv'):
+        words = self.find_words(rows)
+        generated_sentences = []
+
+        with open(output_path, 'w', encoding='utf-8') as output_file:
+            for chunk_rows in self.generate_sentences(words):
+                for row in chunk_rows:
+                    output_file.write(format_row(row) + '\n')
+                output_file.flush()
+                generated_sentences.extend(format_row(row) for row in chunk_rows)
+        return '\n'.join(generated_sentences)
+
+    def card_rows(self, rows):
+        # The generated sentences as input.csv rows of Hanzi, definition and reading, so gencards can use ChatGPT's translation and reading instead of asking Azure
+        rows = list(rows)
+        seen = set(row[0] for row in rows)
+        for chunk_rows in self.generate_sentences(self.find_words(rows)):
+            for sentence, reading, translation in chunk_rows:
+                # Each sentence can only be one card, and ChatGPT sometimes repeats itself
+                if sentence not in seen:
+                    seen.add(sentence)
+                    yield [sentence, translation, reading]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate example sentences for the words in a list of Mandarin words and sentences.')
+    parser.add_argument('--config', default='config.ini', help='Config file, missing options are filled in and written back')
+    parser.add_argument('--input', default='input.csv', help='CSV of Hanzi and optional definitions')
+    parser.add_argument('--output', default='generated_sentences.csv', help='CSV of generated sentences to write')
+    args = parser.parse_args(argv)
+
+    generator = SentenceGenerator(load_config(args.config, interactive=sys.stdin.isatty()))
+    generator.write_sentences(read_input_rows(args.input), args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+logger = logging.getLogger('gencards.hedging')
+
+# Calls a service has to have answered before its latency percentile is trusted for hedging
+min_hedge_samples = 20
+
+def run_in_thread(func):
+    # A daemon thread per call, so a request which never returns can't hold up the run, or the exit once it's given up on
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+class CallPolicy:
+    def __init__(self, name, metrics, timeout, max_retries=0, hedge_percentile=None, retryable=()):
+        self.name = name
+        self.metrics = metrics
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.hedge_percentile = hedge_percentile
+        self.retryable = retryable
+
+    def hedge_after(self):
+        if self.hedge_percentile is None:
+            return None
+        return self.metrics.percentile(self.name, self.hedge_percentile / 100, min_hedge_samples)
+
+    def attempt(self, func):
+        # Waits until the deadline for func, sending a second copy once it's slower than the usual calls, and returns whichever answers first
+        first = run_in_thread(func)
+        futures = [first]
+        deadline = time.monotonic() + self.timeout
+        hedge_after = self.hedge_after()
+        if hedge_after is not None and hedge_after < self.timeout:
+            done, not_done = wait(futures, timeout=hedge_after)
+            if not done:
+                self.metrics.count(self.name + '.hedged')
+                futures.append(run_in_thread(func))
+        error = None
+        while futures:
+            done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                self.metrics.count(self.name + '.timeouts')
+                raise TimeoutError('{0} took longer than {1} seconds'.format(self.name, self.timeout))
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self.metrics.count(self.name + '.hedge_wins')
+                    return future.result()
+                error = future.exception()
+            futures = list(not_done)
+        raise error
+
+    def call(self, func):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.metrics.timer(self.name):
+                    return self.attempt(func)
+            except (TimeoutError,) + tuple(self.retryable) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = random.uniform(0, min(30, 2 ** attempt))
+                self.metrics.count(self.name + '.retries')
+                logger.warning('{0} failed, retrying in {1:.1f} seconds: {2}'.format(self.name, delay, e))
+                time.sleep(delay)
@@ -0,0 +1,48 @@
+import json
+import os
+import threading
+
+class Journal:
+    # One JSON line per finished row, appended as rows finish, so an interrupted run can pick up where it stopped
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.lock = threading.Lock()
+        self.file = None
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line is cut short if the run was killed while writing it
+                        continue
+                    self.records[entry['key']] = entry['record']
+
+    def get(self, key, content_hash):
+        record = self.records.get(key)
+        if record is not None and record['hash'] == content_hash:
+            return record
+        return None
+
+    def append(self, key, record):
+        line = json.dumps({'key': key, 'record': record}, ensure_ascii=False)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.records[key] = record
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def remove(self):
+        # Once the package is written the journal has nothing left to resume
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.records = {}
@@ -0,0 +1,20 @@
+import hashlib
+import json
+import os
+
+def row_hash(row, settings):
+    serialised = json.dumps([row, settings], ensure_ascii=False)
+    return hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(path, manifest):
+    # Written to a temporary file first so an interrupted save can't corrupt the previous manifest
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=1)
+    os.replace(temporary_path, path)
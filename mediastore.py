@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+class MediaStore:
+    def __init__(self, directory, max_size_mb=2000, max_age_days=90):
+        self.directory = directory
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def file_name(text, voice_name, audio_format, extension):
+        # Named by content rather than by text, so similar texts can't collide and identical ones are shared
+        serialised = json.dumps([text, voice_name, audio_format], ensure_ascii=False)
+        return 'gencards-' + hashlib.sha256(serialised.encode('utf-8')).hexdigest()[:32] + extension
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def contains(self, file_name):
+        try:
+            # Reusing a file marks it as recently used, so eviction goes by last use rather than by when it was synthesized
+            os.utime(self.path(file_name))
+            found = True
+        except FileNotFoundError:
+            found = False
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def temporary_path(self, file_name):
+        # Unique to the process and thread, since sharded runs write to the same store from several processes
+        return self.path(file_name) + '.part-{0}-{1}'.format(os.getpid(), threading.get_ident())
+
+    def commit(self, temporary_path, file_name):
+        # Only complete files ever appear under their final name
+        os.replace(temporary_path, self.path(file_name))
+        return self.path(file_name)
+
+    def evict(self, keep=()):
+        # Files unused for max_age go first, then the least recently used until the folder fits in max_size. Files in keep are never removed.
+        keep = set(os.path.abspath(path) for path in keep)
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not entry.name.startswith('gencards-'):
+                continue
+            stat = entry.stat()
+            if '.part-' in entry.name:
+                # Left behind by a run which was killed while writing it
+                if now - stat.st_mtime > self.max_age:
+                    os.remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total_size = sum(size for _, size, _ in files)
+        evicted = 0
+        for modified, size, path in files:
+            if now - modified <= self.max_age and total_size <= self.max_size:
+                break
+            if os.path.abspath(path) in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            evicted += 1
+        with self.lock:
+            self.evicted += evicted
+        return evicted
+
+    def report(self):
+        return 'Media store: {0} reused, {1} synthesized, {2} evicted'.format(self.hits, self.misses, self.evicted)
@@ -0,0 +1,118 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in seconds, anything slower goes in the last bucket
+buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        # The upper bound of the bucket the percentile falls in, which is close enough to spot a slowdown
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(buckets[i], self.max) if i < len(buckets) else self.max
+        return 0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else 0,
+            'p50_seconds': self.percentile(0.5),
+            'p95_seconds': self.percentile(0.95),
+            'max_seconds': self.max,
+            'buckets': {('<=' + str(bound) if i < len(buckets) else '>' + str(buckets[-1])): count
+                        for i, (bound, count) in enumerate(zip(buckets + [None], self.counts)) if count}
+        }
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def percentile(self, name, fraction, min_count=1):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None or histogram.count < min_count:
+                return None
+            return histogram.percentile(fraction)
+
+    def state(self):
+        # Plain histograms and counters, which can be sent back from a worker process and merged
+        with self.lock:
+            return self.histograms, self.counters
+
+    def merge(self, state):
+        histograms, counters = state
+        with self.lock:
+            for name, other in histograms.items():
+                histogram = self.histograms.setdefault(name, Histogram())
+                histogram.counts = [count + other_count for count, other_count in zip(histogram.counts, other.counts)]
+                histogram.count += other.count
+                histogram.total += other.total
+                histogram.max = max(histogram.max, other.max)
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed_seconds': time.time() - self.started,
+                'latency': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items()))
+            }
+
+    def write(self, path, extra=None):
+        summary = self.summary()
+        summary.update(extra or {})
+        with open(path, 'w', encoding='utf-8') as metrics_file:
+            json.dump(summary, metrics_file, indent=2, ensure_ascii=False)
+
+    def table(self):
+        summary = self.summary()
+        lines = ['{0:<36} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9}'.format('Call', 'Count', 'Total s', 'Mean ms', 'p95 ms', 'Max ms')]
+        for name, latency in summary['latency'].items():
+            lines.append('{0:<36} {1:>7} {2:>9.2f} {3:>9.1f} {4:>9.1f} {5:>9.1f}'.format(
+                name, latency['count'], latency['total_seconds'], latency['mean_seconds'] * 1000,
+                latency['p95_seconds'] * 1000, latency['max_seconds'] * 1000))
+        for name, value in summary['counters'].items():
+            lines.append('{0:<36} {1:>7}'.format(name, round(value, 2) if isinstance(value, float) else value))
+        return '\n'.join(lines)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('gencards.pipeline')
+
+class Stage:
+    def __init__(self, name, func, concurrency=1, batch_size=None, batch_wait=0, executor=None, skip=None, attempts=1, retry_delay=0, fallback=None):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.executor = executor
+        self.skip = skip
+        # Items func fails on are tried again up to attempts times in all, then passed on as fallback(item), or the run stops without a fallback
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.fallback = fallback
+        self.failed_attempts = {}
+        self.retries = set()
+        # Time spent inside func, summed over every worker, and the number of items it handled
+        self.busy_time = 0
+        self.processed = 0
+        self.deferred = 0
+        self.failed = 0
+
+async def call_stage(stage, argument):
+    if asyncio.iscoroutinefunction(stage.func):
+        return await stage.func(argument)
+    return await asyncio.get_running_loop().run_in_executor(stage.executor, stage.func, argument)
+
+def defer_failed(stage, pending, error):
+    # Splits a failed call's items into those to try again later and the fallback results of those out of attempts
+    deferred = []
+    results = {}
+    for index, item in pending:
+        stage.failed_attempts[index] = stage.failed_attempts.get(index, 0) + 1
+        if stage.failed_attempts[index] < stage.attempts:
+            deferred.append((index, item))
+        elif stage.fallback is not None:
+            results[index] = stage.fallback(item)
+        else:
+            raise error
+    stage.deferred += len(deferred)
+    stage.failed += len(results)
+    if deferred:
+        logger.warning('Pipeline stage {0} failed, trying {1} items again later: {2}'.format(stage.name, len(deferred), error))
+    if results:
+        logger.error('Pipeline stage {0} failed {1} items for the last time: {2}'.format(stage.name, len(results), error))
+    return deferred, results
+
+async def retry_later(stage, in_queue, index, item):
+    await asyncio.sleep(stage.retry_delay * stage.failed_attempts[index])
+    await in_queue.put((index, item))
+    # Only marked done once it's back in the queue, so the pipeline can't finish while it waits
+    in_queue.task_done()
+
+async def next_item(in_queue, in_closed, timeout):
+    # The next item, or None once the timeout passes or nothing more can come from the stage before
+    get = asyncio.ensure_future(in_queue.get())
+    closed = asyncio.ensure_future(in_closed.wait())
+    done, _ = await asyncio.wait((get, closed), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    closed.cancel()
+    if get in done:
+        return get.result()
+    get.cancel()
+    return None
+
+async def stage_worker(stage, in_queue, out_queue, errors, in_closed):
+    while True:
+        batch = [await in_queue.get()]
+        if stage.batch_size is not None:
+            # Take whatever else arrives within batch_wait so batched stages can share one request,
+            # but send a partial batch straight away once the stage before has finished
+            deadline = asyncio.get_running_loop().time() + stage.batch_wait
+            while len(batch) < stage.batch_size:
+                if not in_queue.empty():
+                    batch.append(in_queue.get_nowait())
+                    continue
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0 or in_closed.is_set():
+                    break
+                item = await next_item(in_queue, in_closed, remaining)
+                if item is None:
+                    break
+                batch.append(item)
+        deferred = []
+        try:
+            # Items this stage should skip are passed straight on, keeping their place in the order
+            pending = [(index, item) for index, item in batch if stage.skip is None or not stage.skip(item)]
+            results = {}
+            started = time.perf_counter()
+            try:
+                if stage.batch_size is None and pending:
+                    results[pending[0][0]] = await call_stage(stage, pending[0][1])
+                elif pending:
+                    processed = await call_stage(stage, [item for index, item in pending])
+                    results = {index: result for (index, item), result in zip(pending, processed)}
+            except Exception as e:
+                # Failed items go to the back of the queue rather than stopping the run, so the other rows keep moving
+                deferred, results = defer_failed(stage, pending, e)
+            stage.busy_time += time.perf_counter() - started
+            stage.processed += len(pending) - len(deferred)
+            for index, item in deferred:
+                task = asyncio.create_task(retry_later(stage, in_queue, index, item))
+                stage.retries.add(task)
+                task.add_done_callback(stage.retries.discard)
+            deferred_indexes = set(index for index, item in deferred)
+            for index, item in batch:
+                if index not in deferred_indexes:
+                    await out_queue.put((index, results[index] if index in results else item))
+        except Exception as e:
+            logger.exception(e)
+            logger.error('Pipeline stage {0} failed'.format(stage.name))
+            errors.append((stage.name, e))
+        finally:
+            for _ in range(len(batch) - len(deferred)):
+                in_queue.task_done()
+
+async def ordered_sink(queue, sink, errors):
+    pending = {}
+    next_index = 0
+    while True:
+        index, item = await queue.get()
+        try:
+            pending[index] = item
+            while next_index in pending:
+                ready_item = pending.pop(next_index)
+                next_index += 1
+                sink(ready_item)
+        except Exception as e:
+            logger.exception(e)
+            errors.append(('sink', e))
+        finally:
+            queue.task_done()
+
+async def run_pipeline(items, stages, sink, queue_size=100):
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    # Set once nothing more will be put on each queue, other than items its own stage retries
+    closed = [asyncio.Event() for _ in queues]
+    errors = []
+    workers = []
+    for stage, in_queue, out_queue, in_closed in zip(stages, queues, queues[1:], closed):
+        for _ in range(stage.concurrency):
+            workers.append(asyncio.create_task(stage_worker(stage, in_queue, out_queue, errors, in_closed)))
+    workers.append(asyncio.create_task(ordered_sink(queues[-1], sink, errors)))
+
+    for index, item in enumerate(items):
+        await queues[0].put((index, item))
+    closed[0].set()
+    # Every worker marks its input done only after passing the result on, so joining in order drains the pipeline
+    for queue, next_closed in zip(queues, closed[1:]):
+        await queue.join()
+        next_closed.set()
+    await queues[-1].join()
+
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    if errors:
+        stage_name, error = errors[0]
+        raise error
@@ -0,0 +1,143 @@
+import logging
+import random
+import re
+import threading
+import time
+
+logger = logging.getLogger('gencards.ratelimit')
+
+def retryable_errors():
+    # openai is slow to import, so it is only imported once a request is made
+    import openai
+    return (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError
+    )
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self.refill(now)
+        # A single request larger than the whole budget only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0
+        return (amount - self.available) / self.rate
+
+    def take(self, amount):
+        self.available -= amount
+
+def parse_duration(value):
+    # OpenAI reset headers look like '1s', '6m0s' or '120ms'
+    seconds = 0
+    for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|s|m|h)', value):
+        seconds += float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+def retry_hint(error):
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    resets = [parse_duration(headers[name]) for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens') if name in headers]
+    if resets:
+        return max(resets)
+    return None
+
+def estimate_tokens(messages, completion_tokens):
+    # Roughly one token per Hanzi, which overestimates English text, so we stay under the budget
+    return sum(len(message['content']) for message in messages) + completion_tokens
+
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, max_retries=5, base_delay=1, max_delay=60, request_timeout=None):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Seconds before a stalled request is given up on, which raises a Timeout and is retried like any other error
+        self.request_timeout = request_timeout
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.rate_limited = 0
+        self.waited = 0
+
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    return
+                self.waited += wait
+            time.sleep(wait)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        with self.lock:
+            self.tokens.available += estimated_tokens - actual_tokens
+
+    def backoff_delay(self, attempt, error):
+        hint = retry_hint(error)
+        if hint is not None:
+            return hint + random.uniform(0, min(hint, self.base_delay))
+        # Full jitter, so callers which failed together don't all retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, estimated_tokens=0):
+        import openai
+        for attempt in range(self.max_retries + 1):
+            self.acquire(estimated_tokens)
+            try:
+                return func()
+            except retryable_errors() as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt, e)
+                with self.lock:
+                    self.retries += 1
+                if isinstance(e, openai.error.RateLimitError):
+                    # Every caller shares the quota, so everyone waits rather than spending more requests on 429s
+                    with self.lock:
+                        self.rate_limited += 1
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                    logger.warning('Reached OpenAI rate limit, pausing requests for {0:.1f} seconds'.format(delay))
+                else:
+                    logger.warning('OpenAI exception, retrying in {0:.1f} seconds: {1}'.format(delay, e))
+                    time.sleep(delay)
+
+def create_chat_completion(rate_limiter, completion_tokens=500, **kwargs):
+    import openai
+    estimated_tokens = estimate_tokens(kwargs['messages'], completion_tokens)
+    if rate_limiter.request_timeout:
+        kwargs['request_timeout'] = rate_limiter.request_timeout
+    chat_completion = rate_limiter.call(lambda: openai.ChatCompletion.create(**kwargs), estimated_tokens)
+    usage = getattr(chat_completion, 'usage', None)
+    if usage:
+        rate_limiter.record_usage(estimated_tokens, usage['total_tokens'])
+    return chat_completion
+
+def rate_limiter_from_config(openai_config):
+    return RateLimiter(openai_config.getint('requests_per_minute'),
+                       openai_config.getint('tokens_per_minute'),
+                       max_retries=openai_config.getint('max_retries'),
+                       request_timeout=openai_config.getfloat('request_timeout'))
@@ -0,0 +1,137 @@
+from dragonmapper import hanzi, transcriptions
+
+digits = set('〇零一二三四五六七八九十两兩')
+
+punctuation = {
+    '，': ',', '。': '.', '？': '?', '！': '!', '：': ':', '；': ';', '、': ',',
+    '（': '(', '）': ')', '「': '"', '」': '"', '『': '"', '』': '"', '“': '"', '”': '"',
+    '‘': '\'', '’': '\'', '《': '<', '》': '>', '～': '~', '…': '...'
+}
+
+# Characters segmented on their own whose reading depends on the characters either side, e.g. 很长 cháng but 长得 zhǎng and
+# 还没 hái but 还钱 huán. The first rule whose characters before and after match wins, and an empty set matches anything.
+polyphone_rules = {
+    '长': [('zhang3', set(), set('大得了出成')), ('chang2', set(), set())],
+    '長': [('zhang3', set(), set('大得了出成')), ('chang2', set(), set())],
+    '还': [('huan2', set(), set('钱书债款给清')), ('hai2', set(), set())],
+    '還': [('huan2', set(), set('錢書債款給清')), ('hai2', set(), set())],
+    '得': [('de2', set('我你他她它们們'), set('了')), ('dei3', set('我你他她它们們就也都还還总總'), set()), ('de5', set(), set())],
+    '教': [('jiao1', set(), set())]
+}
+
+def tone(syllable):
+    if syllable and syllable[-1].isdigit():
+        return int(syllable[-1])
+    return None
+
+def common_syllable(character):
+    if not hanzi.has_chinese(character):
+        return None
+    try:
+        # dragonmapper lists the most common reading first, which suits a character on its own
+        syllable = hanzi.to_pinyin(character, accented=False)
+    except Exception:
+        return None
+    return syllable if tone(syllable) is not None else None
+
+def dictionary_syllables(token, lookup):
+    results = [result for result in lookup(token) if result.pinyin is not None]
+    # Capitalised CC-CEDICT readings are proper nouns, so prefer a common word with the same characters
+    for result in results:
+        if not result.pinyin[0][:1].isupper():
+            return result.pinyin
+    return results[0].pinyin if results else None
+
+def character_syllable(character, lookup):
+    readings = [result.pinyin[0].replace('u:', 'ü').lower() for result in lookup(character) if result.pinyin is not None and len(result.pinyin) == 1]
+    syllable = common_syllable(character)
+    # The dictionary doesn't say which reading is the common one, but dragonmapper sometimes gives a reading it doesn't have at all, e.g. li5 for 李
+    if not readings or syllable in readings:
+        return syllable
+    return dictionary_syllables(character, lookup)[0].replace('u:', 'ü').lower()
+
+def token_syllables(token, lookup):
+    if not hanzi.has_chinese(token):
+        return None
+    if len(token) > 1:
+        syllables = dictionary_syllables(token, lookup)
+        if syllables is not None and len(syllables) == len(token):
+            return [syllable.replace('u:', 'ü') for syllable in syllables]
+    syllables = [character_syllable(character, lookup) for character in token]
+    if None in syllables:
+        return None
+    return syllables
+
+def polyphone_syllable(tokens, i):
+    previous_character = tokens[i - 1][-1:] if i > 0 else ''
+    next_character = tokens[i + 1][:1] if i + 1 < len(tokens) else ''
+    for syllable, before, after in polyphone_rules.get(tokens[i], ()):
+        if (not before or previous_character in before) and (not after or next_character in after):
+            return syllable
+    return None
+
+def local_syllables(analysis, lookup):
+    tokens = list(analysis.tokens())
+    readings = []
+    for i, token in enumerate(tokens):
+        # Words from the dictionary already come with the reading they take in that word
+        syllable = polyphone_syllable(tokens, i)
+        readings.append((token, [syllable] if syllable is not None else token_syllables(token, lookup)))
+    return readings
+
+def unresolved_tokens(token_readings):
+    return [token for token, syllables in token_readings if syllables is None and hanzi.has_chinese(token)]
+
+def apply_tone_sandhi(characters, syllables):
+    # Only the 一 and 不 changes are written in Pinyin, third tone sandhi is left for the reader
+    result = list(syllables)
+    for i, (character, syllable) in enumerate(zip(characters, syllables)):
+        next_tone = tone(syllables[i + 1]) if i + 1 < len(syllables) else None
+        if character == '一' and syllable == 'yi1' and next_tone is not None:
+            previous_character = characters[i - 1] if i > 0 else ''
+            next_character = characters[i + 1]
+            # Ordinals and numbers keep the first tone
+            if previous_character == '第' or previous_character in digits or next_character in digits:
+                continue
+            # Between a reduplicated verb, as in 看一看, it is neutral
+            if previous_character == next_character:
+                result[i] = 'yi5'
+                continue
+            result[i] = 'yi2' if next_tone == 4 else 'yi4'
+        elif character == '不' and syllable == 'bu4' and next_tone == 4:
+            result[i] = 'bu2'
+    return result
+
+def render_reading(token_readings, fallback_readings):
+    characters = []
+    syllables = []
+    spans = []
+    for token, syllables_for_token in token_readings:
+        start = len(characters)
+        if syllables_for_token is not None:
+            characters.extend(token)
+            syllables.extend(syllables_for_token)
+        else:
+            characters.append(token)
+            syllables.append(None)
+        spans.append((token, syllables_for_token is not None, start, len(characters)))
+    syllables = apply_tone_sandhi(characters, syllables)
+
+    words = []
+    for token, is_resolved, start, end in spans:
+        if is_resolved:
+            words.append(transcriptions.numbered_to_accented(''.join(syllables[start:end])))
+        elif token in fallback_readings:
+            words.append(fallback_readings[token].replace(' ', ''))
+        elif token.strip() == '':
+            continue
+        elif all(not character.isalnum() for character in token):
+            # Punctuation belongs to the word before it, the way ChineseAnalyzer.pinyin() writes it
+            mark = ''.join(punctuation.get(character, character) for character in token)
+            if words:
+                words[-1] += mark
+            else:
+                words.append(mark)
+        else:
+            words.append(token)
+    return ' '.join(words)
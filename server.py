@@ -0,0 +1,244 @@
+import argparse
+import configparser
+import json
+import logging
+import os
+import sys
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gencards
+from metrics import Metrics
+
+logger = logging.getLogger('gencards.server')
+
+# Options a job may set for itself. Keys and endpoints stay as the daemon was started with, since every job shares its clients.
+job_options = {
+    'mandarin': ('is_trad', 'reading_format', 'is_local_reading_enabled'),
+    'azure': ('speech_api_voice_name', 'speech_audio_format', 'speech_batch_size'),
+    'openai': ('is_chatgpt_enabled', 'similar_words_batch_size'),
+    'collection': ('is_collection_enabled', 'path')
+}
+
+class WarmResources:
+    def __init__(self):
+        self.resources = {}
+        self.lock = threading.RLock()
+
+    def close(self):
+        with self.lock:
+            for key, resource in self.resources.items():
+                name = key.split(':')[0]
+                if name == 'synthesis_pool':
+                    resource.shutdown()
+                elif name in ('dictionary_index', 'cache'):
+                    resource.close()
+
+class CardService:
+    def __init__(self, config):
+        self.config = config
+        self.server_config = config['server']
+        self.shared = WarmResources()
+        # Every job shares the speech workers and the OpenAI rate limiter, and at most max_jobs run at once
+        self.job_slots = threading.BoundedSemaphore(self.server_config.getint('max_jobs'))
+        self.metrics = Metrics()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.finished = 0
+        self.failed = 0
+
+    def job_config(self, options=None):
+        config = configparser.ConfigParser()
+        config.read_dict(self.config)
+        for name, value in (options or {}).items():
+            section, _, option = name.partition('.')
+            if option not in job_options.get(section, ()):
+                raise ValueError('Jobs can\'t set {0}'.format(name))
+            config[section][option] = str(value)
+        # Jobs run side by side in this process, so they can't share a manifest or journal file, or leave it for worker processes
+        config['incremental']['is_incremental_enabled'] = 'false'
+        config['checkpoint']['is_checkpoint_enabled'] = 'false'
+        config['pipeline']['processes'] = '1'
+        return config
+
+    def warm_up(self):
+        started = time.perf_counter()
+        generator = gencards.CardGenerator(self.job_config(), shared=self.shared)
+        generator.word_model
+        generator.sentence_model
+        generator.parse('你好')
+        generator.text_translator
+        generator.speech_config
+        generator.synthesis_pool
+        generator.cache
+        generator.media_store
+        if generator.is_chatgpt_enabled:
+            generator.rate_limiter
+        # Modules the first job would otherwise import
+        import reading
+        from azure.ai.translation.text.models import InputTextItem
+        from dragonmapper import hanzi
+        logger.info('Warmed up in {0:.2f}s'.format(time.perf_counter() - started))
+
+    def prepare_job(self, job):
+        # Checks a job before it takes a slot, raising ValueError for anything the client got wrong
+        if not isinstance(job, dict):
+            raise ValueError('A job is a JSON object')
+        if not isinstance(job.get('options', {}), dict):
+            raise ValueError('options is a JSON object of section.option names and values')
+        rows = job.get('rows')
+        if rows is None and 'input' in job:
+            if not isinstance(job['input'], str):
+                raise ValueError('input is the path of a csv file')
+            try:
+                rows = list(gencards.read_input_rows(job['input']))
+            except OSError as e:
+                raise ValueError('Can\'t read {0}: {1}'.format(job['input'], e.strerror))
+        if not isinstance(rows, list) or not rows or not all(isinstance(row, list) and len(row) > 0 and all(isinstance(field, str) for field in row) for row in rows):
+            raise ValueError('A job needs rows, a list of [Hanzi, definition, reading] lists with optional definition and reading, or an input csv path')
+        if not isinstance(job.get('output', ''), str):
+            raise ValueError('output is the path of the .apkg to write')
+        job_id = uuid.uuid4().hex[:12]
+        output_path = os.path.abspath(job.get('output') or os.path.join(self.server_config.get('output_path'), job_id + '.apkg'))
+        # Creating the generator reads every option with its type, so a value such as is_trad=banana is refused here too
+        generator = gencards.CardGenerator(self.job_config(job.get('options')), shared=self.shared)
+        return {'id': job_id, 'rows': rows, 'output': output_path, 'generator': generator}
+
+    def run_job(self, job):
+        with self.job_slots:
+            with self.lock:
+                self.running += 1
+            generator = job['generator']
+            started = time.perf_counter()
+            try:
+                os.makedirs(os.path.dirname(job['output']), exist_ok=True)
+                deck = generator.build_deck(job['rows'], job['output'])
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                raise
+            finally:
+                generator.close(report=False)
+                self.metrics.merge(generator.metrics.state())
+                with self.lock:
+                    self.running -= 1
+            seconds = time.perf_counter() - started
+        with self.lock:
+            self.finished += 1
+        logger.info('Job {0}: {1} notes from {2} rows in {3:.2f}s, written to {4}'.format(job['id'], len(deck.notes), len(job['rows']), seconds, job['output']))
+        return {
+            'id': job['id'],
+            'path': job['output'],
+            'notes': len(deck.notes),
+            'seconds': seconds,
+            'counters': generator.metrics.summary()['counters']
+        }
+
+    def status(self):
+        with self.lock:
+            return {
+                'running': self.running,
+                'finished': self.finished,
+                'failed': self.failed,
+                'uptime_seconds': time.time() - self.metrics.started,
+                'warm': sorted(self.shared.resources)
+            }
+
+    def close(self):
+        # Jobs share the media store, so unused audio is only evicted once none are running
+        gencards.CardGenerator(self.job_config(), shared=self.shared).evict_media()
+        self.shared.close()
+        logger.info('Daemon metrics:\n' + self.metrics.table())
+
+class JobHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.service.status())
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.service.metrics.summary())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            job = self.server.service.prepare_job(json.loads(body or b'null'))
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # Anything else is the daemon's fault, but the client still gets an answer rather than a dropped connection
+            logger.exception(e)
+            self.send_json(500, {'error': str(e)})
+            return
+        try:
+            result = self.server.service.run_job(job)
+        except Exception as e:
+            logger.exception(e)
+            self.send_json(500, {'id': job['id'], 'error': str(e)})
+            return
+        self.send_json(200, result)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logger.debug('{0} - {1}'.format(self.address_string(), format % args))
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def create_server(service, host, port, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, JobHandler)
+        # Only the user running the daemon can submit jobs
+        os.chmod(socket_path, 0o600)
+    else:
+        server = ThreadingHTTPServer((host, port), JobHandler)
+    server.service = service
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Keep gencards running with warm clients and dictionaries, building decks for jobs sent over local HTTP or a Unix socket.')
+    parser.add_argument('--config', default='config.ini', help='Config file, missing options are filled in and written back')
+    parser.add_argument('--host', help='Address to listen on, overriding the host option')
+    parser.add_argument('--port', type=int, help='Port to listen on, overriding the port option')
+    parser.add_argument('--socket', help='Listen on this Unix socket instead, overriding the socket_path option')
+    args = parser.parse_args(argv)
+
+    gencards.setup_logging()
+    config = gencards.load_config(args.config, interactive=sys.stdin.isatty())
+    server_config = config['server']
+    socket_path = args.socket or server_config.get('socket_path')
+    service = CardService(config)
+    service.warm_up()
+    server = create_server(service, args.host or server_config.get('host'), args.port or server_config.getint('port'), socket_path)
+    logger.info('Listening on {0}'.format(socket_path or '{0}:{1}'.format(*server.server_address)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import io
+import re
+import wave
+from xml.sax.saxutils import escape, quoteattr
+
+# Silence between the words of a batch, and how much of it each clip keeps either side of its word
+pause_ms = 500
+padding_ms = 100
+ticks_per_second = 10000000
+
+def is_splittable(audio_format):
+    # Only uncompressed PCM can be cut at an arbitrary offset without an encoder
+    return (audio_format.startswith('riff') or audio_format.startswith('raw')) and audio_format.endswith('pcm')
+
+def sample_rate(audio_format):
+    # Azure names rates either way, e.g. riff-16khz-16bit-mono-pcm or riff-22050hz-16bit-mono-pcm
+    match = re.search(r'(\d+)(k?)hz', audio_format)
+    if match is None:
+        raise ValueError('No sample rate in speech_audio_format: {0}'.format(audio_format))
+    return int(match.group(1)) * (1000 if match.group(2) else 1)
+
+def batch_ssml(texts, voice_name):
+    # A bookmark before every word and one at the end, so the offset of each reports where its word starts
+    language = '-'.join(voice_name.split('-')[:2])
+    words = ''.join('<bookmark mark="{0}"/>{1}<break time="{2}ms"/>'.format(i, escape(text), pause_ms) for i, text in enumerate(texts))
+    return '<speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang={0}><voice name={1}>{2}<bookmark mark="end"/></voice></speak>'.format(
+        quoteattr(language), quoteattr(voice_name), words)
+
+def read_pcm(audio_data, audio_format):
+    # riff formats come with a wav header, raw ones are bare 16 bit mono samples
+    if audio_data[:4] == b'RIFF':
+        with wave.open(io.BytesIO(audio_data), 'rb') as wave_file:
+            return wave_file.getframerate(), wave_file.getsampwidth(), wave_file.readframes(wave_file.getnframes())
+    return sample_rate(audio_format), 2, audio_data
+
+def split_clips(frames, sample_rate, sample_width, offsets, count):
+    # offsets maps each bookmark to its audio offset in ticks, returns the frames of each word or None where a bookmark is missing
+    total = len(frames) // sample_width
+    marks = [offsets.get(str(i)) for i in range(count)] + [offsets.get('end')]
+    clips = []
+    for i in range(count):
+        if marks[i] is None or marks[i + 1] is None:
+            clips.append(None)
+            continue
+        start = marks[i] * sample_rate // ticks_per_second - padding_ms * sample_rate // 1000
+        end = marks[i + 1] * sample_rate // ticks_per_second - (pause_ms - padding_ms) * sample_rate // 1000
+        start = max(0, start)
+        end = min(total, end)
+        clips.append(frames[start * sample_width:end * sample_width] if end > start else None)
+    return clips
+
+def write_wav(path, frames, sample_rate, sample_width):
+    with wave.open(path, 'wb') as wave_file:
+        wave_file.setnchannels(1)
+        wave_file.setsampwidth(sample_width)
+        wave_file.setframerate(sample_rate)
+        wave_file.writeframes(frames)